@@ -0,0 +1,136 @@
+# coding=utf-8
+import argparse
+import csv
+import sys
+import time
+
+import test_graph
+import SER
+import LoadData
+import Compartments
+
+STATES = Compartments.STATES  # States counted for each Tc group
+
+
+class CBatchRun:
+    """This class runs the SER simulation without the graphical interface. The vertices are placed on map coordinates,
+    which do not depend on a widget, so the simulation can run on machines without a display and the engine can be
+    measured without the drawing overhead."""
+
+    def __init__(self, sf="shapefile/clipabaetetubasolo.shp", use_cache=True):
+        self.ld = LoadData.CLoadData()
+        self.ser = SER.CSER()
+        self.env_graph = test_graph.CEnvironmentGraph(species=self.ld.read_species(),
+                                                      connections=self.ld.read_connections())
+        self.env_graph.use_cache = use_cache
+        self.env_graph.read_shapes(sf)
+        self.graph = self.env_graph.get_graph()
+        self.groups = self.env_graph.get_groups()
+
+    def gen_graph(self):
+        """Create the vertices and edges of the environment graph"""
+        self.env_graph.gen_graph()
+
+    def save_initial_state(self):
+        """Keep the state of all vertices, so other simulations can start from the same state"""
+        self.initial_state = Compartments.CCompartments.of_graph(self.graph).state.copy()
+
+    def restore_initial_state(self):
+        """Give back to the vertices the states saved by save_initial_state and restart the SER algorithm"""
+        Compartments.CCompartments.of_graph(self.graph).state[...] = self.initial_state
+        self.ser.load_graph(self.graph)
+
+    def infect(self, group, count):
+        """
+        Change the state of random vertices to infected for a Tc group.
+        :param group: Tc group of the infection
+        :type group: str
+        :param count: Number of vertices to be infected
+        :type count: int
+        :return: None
+        :rtype: None
+        """
+        for i in range(count):
+            self.ser.random_infect_specie(graph=self.graph, group=group)
+
+    def count_states(self):
+        """
+        Count the vertices on each state for each Tc group.
+        :return: Dictionary with the number of vertices on each state, for each group
+        :rtype: dict
+        """
+        compartments = Compartments.CCompartments.of_graph(self.graph)
+        counts = {group: dict.fromkeys(STATES, 0) for group in self.groups}
+        for group in self.groups:
+            index = compartments.get_group_index(group)
+            if index is not None:
+                counts[group].update(zip(STATES, compartments.count(index).tolist()))
+        return counts
+
+    def update_counts(self, counts):
+        """Update the counts of states with the changes made by the last step, instead of counting all vertices"""
+        compartments = Compartments.CCompartments.of_graph(self.graph)
+        operating, vertices, indexes, states = self.ser.history.get_step(self.ser.iterations - 1)
+        first_state = {}
+        for v, index, state in zip(vertices.tolist(), indexes.tolist(), states.tolist()):
+            # A vertex can change more than once in a step, only its state before the step matters
+            first_state.setdefault((v, index), state)
+        for (v, index), state in first_state.items():
+            group = compartments.groups[index]
+            counts[group][STATES[state]] -= 1
+            counts[group][STATES[compartments.state[v, index]]] += 1
+
+    def run(self, steps):
+        """
+        Run the simulation forward, yielding the counts of states after each step.
+        :param steps: Number of steps to run
+        :type steps: int
+        :return: Generator of (iteration, counts) tuples, starting by the current iteration
+        :rtype: generator
+        """
+        counts = self.count_states()
+        yield self.ser.get_iterations_number(), counts
+        for i in range(steps):
+            self.ser.run(g=self.graph, is_forward=True, go=None)
+            self.update_counts(counts)
+            yield self.ser.get_iterations_number(), counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the contamination spreading simulation without the graphical "
+                                                 "interface and write the number of vertices on each state per step.")
+    parser.add_argument("-n", "--steps", type=int, default=100, help="number of SER steps to run")
+    parser.add_argument("-g", "--group", default=None, help="Tc group of the initial infection (default: first one)")
+    parser.add_argument("-i", "--infected", type=int, default=1, help="number of vertices infected at the start")
+    parser.add_argument("-o", "--output", default=None, help="CSV file to write the counts (default: stdout)")
+    parser.add_argument("--shapefile", default="shapefile/clipabaetetubasolo.shp", help="shapefile of the habitats")
+    parser.add_argument("--no-cache", action="store_true", help="generate the graph again instead of loading it "
+                                                                "from the cache")
+    args = parser.parse_args(argv)
+
+    batch = CBatchRun(sf=args.shapefile, use_cache=not args.no_cache)
+    start = time.time()
+    batch.gen_graph()
+    print("Graph generated in %.2f s" % (time.time() - start), file=sys.stderr)
+
+    group = args.group if args.group is not None else batch.groups[0]
+    batch.infect(group=group, count=args.infected)
+
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        writer = csv.writer(output)
+        writer.writerow(["iteration", "group"] + STATES)
+        start = time.time()
+        for iteration, counts in batch.run(steps=args.steps):
+            for grp in batch.groups:
+                writer.writerow([iteration, grp] + [counts[grp][state] for state in STATES])
+        elapsed = time.time() - start
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print("%d steps in %.2f s (%.1f steps/s)" % (args.steps, elapsed, args.steps / max(elapsed, 1e-9)),
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# coding=utf-8
+import numpy
+
+# The position of each state and spread model on these lists is the code stored on the matrices of CCompartments
+STATES = ["S", "I", "R"]
+S, I, R = 0, 1, 2
+SPREAD_MODELS = ["SI", "SIS", "SIR"]
+SI, SIS, SIR = 0, 1, 2
+
+
+class CCompartments:
+    """This class keeps the state of all vertices for all Tc groups in a matrix of codes, with one row for each vertex
+    and one column for each group. A mask identifies the groups that can infect each vertex and another matrix keeps
+    the spread model the vertex follows for each group. The object is stored as the "compartments" graph property, so
+    everyone that handles the graph uses the same states."""
+
+    def __init__(self, groups, num_vertices):
+        """
+        :param groups: All Tc groups specified on the configuration files
+        :type groups: list
+        :param num_vertices: Number of vertices of the graph
+        :type num_vertices: int
+        """
+        self.groups = list(groups)
+        self.group_index = {group: index for index, group in enumerate(self.groups)}
+        shape = (num_vertices, len(self.groups))
+        self.state = numpy.zeros(shape, dtype=numpy.uint8)
+        self.eligible = numpy.zeros(shape, dtype=bool)
+        self.spread_model = numpy.zeros(shape, dtype=numpy.uint8)
+
+    @staticmethod
+    def of_graph(graph):
+        """Return the compartments stored on the graph"""
+        return graph.graph_properties["compartments"]
+
+    def get_group_index(self, group):
+        """Return the column of a Tc group on the matrices, or None if no vertex can be infected by it"""
+        return self.group_index.get(group)
+
+    def set_vertex(self, v, groups, spread_models, states):
+        """
+        Set the Tc groups that can infect a vertex, with the spread model and the state of the vertex for each one.
+        :param v: Index of the vertex
+        :type v: int
+        :param groups: Tc groups that can infect the vertex
+        :type groups: list
+        :param spread_models: Spread model of each group, as a string of SPREAD_MODELS
+        :type spread_models: list
+        :param states: State of each group, as a string of STATES
+        :type states: list
+        :return: None
+        :rtype: None
+        """
+        v = int(v)
+        for group, spread_model, state in zip(groups, spread_models, states):
+            index = self.group_index[group]
+            self.eligible[v, index] = True
+            self.spread_model[v, index] = SPREAD_MODELS.index(spread_model)
+            self.state[v, index] = STATES.index(state)
+
+    def get_vertex_states(self, v, groups):
+        """Return the state of a vertex for each one of the Tc groups, as strings"""
+        v = int(v)
+        return [STATES[self.state[v, self.group_index[group]]] for group in groups]
+
+    def count(self, index):
+        """Count the vertices that can be infected by a Tc group on each state"""
+        return numpy.bincount(self.state[self.eligible[:, index], index], minlength=len(STATES))
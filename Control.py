@@ -1,8 +1,14 @@
 # coding=utf-8
+import threading
+
+import numpy
+
 import test_graph
 import SER
 import LoadData
 import SaveData
+import SimulationWorker
+import GenerationJob
 
 class CController():
     """
@@ -19,6 +25,13 @@ class CController():
                                                       connections=self.ld.read_connections())
         self.graph = self.env_graph.get_graph()
 
+        # The simulation can run on the thread of a CSimulationWorker. The lock keeps the steps of that thread apart
+        # from the changes made by the interface, and the last frame shown is used to find what must be drawn again.
+        self.lock = threading.Lock()
+        self.worker = None
+        self.shown_frame = None
+        self.generation = None  # Last job started to generate the graph
+
     def get_graph(self):
         """Get the graph that will be drawn in the environment page"""
         return self.env_graph.get_graph()
@@ -26,26 +39,159 @@ class CController():
     def set_shapefile(self, sf):
         self.env_graph.read_shapes(sf)
 
-    def update_widget_dim(self, w_width, w_height, w_pos_x, w_pos_y):
-        self.env_graph.update_dimensions(w_width, w_height, w_pos_x, w_pos_y)
-
     def gen_graph(self):
         self.env_graph.gen_graph()
 
+    def start_generation(self, dispatch, on_progress=None, on_done=None):
+        """
+        Start generating the graph on the background, cancelling the generation in progress. The graph is replaced
+        only at the end, on the thread that calls the dispatched functions.
+        :param dispatch: Function that schedules a call on the thread of the interface, like GLib.idle_add
+        :type dispatch: function
+        :param on_progress: Function called as on_progress(stage, done, total) while the graph is built
+        :type on_progress: function
+        :param on_done: Function called as on_done(committed) when the generation ends or is cancelled
+        :type on_done: function
+        :return: None
+        :rtype: None
+        """
+        self.cancel_generation()
+        self.generation = GenerationJob.CGenerationJob(env_graph=self.env_graph,
+                                                       dispatch=dispatch,
+                                                       on_progress=on_progress,
+                                                       on_done=on_done,
+                                                       previous=self.generation)
+        self.generation.start()
+
+    def is_generating(self):
+        """Verify if the graph is being generated on the background"""
+        return self.generation is not None and not self.generation.is_finished()
+
+    def cancel_generation(self):
+        """Cancel the generation of the graph in progress, leaving the graph unchanged"""
+        if self.generation is not None:
+            self.generation.cancel()
+
     def get_iterations(self):
         return self.ser.get_iterations_number()
 
+    def get_dirty_vertices(self):
+        """Return the vertices changed by the last step, which are the only ones that need to be drawn again"""
+        return self.ser.get_dirty_vertices()
+
     def step_backward(self, graph, group_observed):
         """Start a backward step in SER algorithm and return the graph to be drawn"""
-        return self.ser.run(g=graph, is_forward=False, go=group_observed)
+        with self.lock:
+            graph = self.ser.run(g=graph, is_forward=False, go=group_observed)
+            return self.ser.sync_graph(graph)
 
     def step_forward(self, graph, group_observed):
         """Start a forward step in SER algorithm and return the graph to be drawn"""
-        return self.ser.run(g=graph, is_forward=True, go=group_observed)
+        with self.lock:
+            graph = self.ser.run(g=graph, is_forward=True, go=group_observed)
+            return self.ser.sync_graph(graph)
 
     def reset(self, graph, group_observed):
         """Reset the SER algorithm for the initial state and return the graph to be drawn"""
-        return self.ser.reset(g=graph, go=group_observed)
+        with self.lock:
+            graph = self.ser.reset(g=graph, go=group_observed)
+            self.env_graph.upd_state(group_observed)
+            return self.ser.sync_graph(graph)
+
+    def seek(self, graph, group_observed, iteration):
+        """Go directly to an iteration of the SER algorithm and return the graph to be drawn"""
+        with self.lock:
+            graph = self.ser.seek(g=graph, go=group_observed, iteration=iteration)
+            self.env_graph.upd_state(group_observed)
+            return self.ser.sync_graph(graph)
+
+    def start_simulation(self, graph, interval, frame_interval=0.0):
+        """
+        Start running steps forward continuously on a thread. The graph is not changed by the thread, the frames it
+        produces are applied to the graph by update_from_frames.
+        :param graph: Graph used on simulation
+        :type graph: graph_tool.Graph
+        :param interval: Time in seconds between the start of two steps, zero to run as fast as possible
+        :type interval: float
+        :param frame_interval: Minimum time in seconds between two frames produced by the thread
+        :type frame_interval: float
+        :return: None
+        :rtype: None
+        """
+        with self.lock:
+            self.ser.check_graph(graph)
+            self.shown_frame = SimulationWorker.CFrame.of_simulation(self.ser)
+        self.worker = SimulationWorker.CSimulationWorker(ser=self.ser, graph=graph, lock=self.lock, interval=interval,
+                                                         frame_interval=frame_interval)
+        self.worker.start()
+
+    def stop_simulation(self):
+        """Ask the simulation thread to stop. The frames already produced can still be consumed"""
+        if self.worker is not None:
+            self.worker.stop()
+
+    def set_simulation_interval(self, interval, frame_interval=0.0):
+        """Change the time in seconds between the start of two steps of the simulation thread and the minimum time
+        between two frames it produces"""
+        if self.worker is not None:
+            self.worker.set_interval(interval, frame_interval)
+
+    def get_simulation_steps(self):
+        """Return the number of steps run by the simulation thread since it started"""
+        if self.worker is None:
+            return 0
+        return self.worker.steps
+
+    def is_simulation_running(self):
+        """Verify if the simulation thread is running or has frames not consumed yet"""
+        return self.worker is not None
+
+    def update_from_frames(self, graph, group_observed):
+        """
+        Apply to the graph the newest frame produced by the simulation thread. The older frames are dropped, so the
+        interface shows only the last step when the drawing is slower than the simulation. After the thread stops,
+        the graph is synchronized with the simulation and the worker is discarded.
+        :param graph: Graph used on simulation
+        :type graph: graph_tool.Graph
+        :param group_observed: Tc group that is being observed by the user
+        :type group_observed: str
+        :return: Iteration of the frame applied and the vertices that must be drawn again, None if there was no new
+        frame, or the iteration and None if the whole graph must be drawn again
+        :rtype: tuple
+        """
+        frames = self.worker.get_frames()
+        if not frames:
+            if self.worker.is_alive():
+                return None
+            # The last steps may have no frame, because the frames are dropped or skipped when the thread is faster
+            self.worker = None
+            self.shown_frame = None
+            with self.lock:
+                graph = self.ser.sync_graph(graph)
+                self.env_graph.upd_state(group_observed)
+            return self.ser.get_iterations_number(), None
+
+        frame = frames[-1]
+        shown = self.shown_frame
+        # Only the vertices with another state for the observed group or with edges reverted need to be drawn
+        changed_edges = numpy.flatnonzero(frame.edges[:, 0] != shown.edges[:, 0])
+        dirty = [shown.edges[changed_edges].ravel()]
+        index = self.ser.compartments.get_group_index(group_observed)
+        if index is not None:
+            dirty.append(numpy.flatnonzero(frame.state[:, index] != shown.state[:, index]))
+        dirty = numpy.unique(numpy.concatenate(dirty).astype(numpy.int64))
+
+        # The simulation thread does not read the graph edges, so they are changed without holding the lock
+        if len(changed_edges) > len(frame.edges) // 4:
+            graph.clear_edges()
+            graph.add_edge_list(frame.edges)
+        else:
+            for source, target in shown.edges[changed_edges]:
+                graph.remove_edge(graph.edge(source, target))
+                graph.add_edge(target, source)
+        self.env_graph.upd_state(group_observed, state=frame.state, vertices=dirty)
+        self.shown_frame = frame
+        return frame.iteration, dirty
 
     def get_spread_models(self):
         """Use object from class LoadData to access configuration JSON file and retrieve the spread models"""
@@ -83,7 +229,8 @@ class CController():
         :return: None
         :rtype: None
         """
-        self.ser.random_infect_specie(graph=graph, group=group)
+        with self.lock:
+            self.ser.random_infect_specie(graph=graph, group=group)
 
     def get_available_groups(self):
         """
@@ -101,4 +248,8 @@ class CController():
         :return: None
         :rtype: None
         """
-        self.env_graph.upd_state(group)
+        if self.shown_frame is not None:
+            # While the simulation thread runs, the colors follow the last frame shown
+            self.env_graph.upd_state(group, state=self.shown_frame.state)
+        else:
+            self.env_graph.upd_state(group)
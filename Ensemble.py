@@ -0,0 +1,133 @@
+# coding=utf-8
+import argparse
+import csv
+import multiprocessing
+import sys
+import time
+
+import numpy
+
+import BatchRun
+
+# Simulation used by the worker processes. It is set before the pool is created, so the workers started by fork
+# receive a copy-on-write view of the graph instead of a pickled copy for each task.
+_batch = None
+
+
+def _run_simulation(task):
+    """Run one simulation on a worker process and return the number of vertices on each state after each step"""
+    seed, steps, group, infected = task
+    batch = _batch
+    batch.restore_initial_state()
+    batch.ser.seed(seed)
+    batch.infect(group=group, count=infected)
+
+    counts = numpy.zeros((steps + 1, len(batch.groups), len(BatchRun.STATES)), dtype=numpy.int32)
+    for step, (iteration, step_counts) in enumerate(batch.run(steps=steps)):
+        for i, grp in enumerate(batch.groups):
+            counts[step, i] = [step_counts[grp][state] for state in BatchRun.STATES]
+    return counts
+
+
+class CEnsemble:
+    """This class runs many independent simulations of the same environment graph on a pool of processes. A single
+    simulation is only one realization of the spreading, so the results of all simulations are aggregated to estimate
+    the evolution of the states on each iteration."""
+
+    def __init__(self, batch, processes=None):
+        """
+        :param batch: Simulation with the environment graph already generated
+        :type batch: BatchRun.CBatchRun
+        :param processes: Number of worker processes, or None to use the number of CPUs
+        :type processes: int
+        """
+        self.batch = batch
+        self.processes = processes
+
+    def run(self, runs, steps, group, infected=1, seed=None, quantiles=(0.05, 0.5, 0.95)):
+        """
+        Run the simulations and aggregate the number of vertices on each state.
+        :param runs: Number of simulations
+        :type runs: int
+        :param steps: Number of SER steps of each simulation
+        :type steps: int
+        :param group: Tc group of the initial infection
+        :type group: str
+        :param infected: Number of random vertices infected at the start of each simulation
+        :type infected: int
+        :param seed: Seed of the ensemble. Each simulation receives its own independent stream derived from it
+        :type seed: int
+        :param quantiles: Quantiles to be calculated over the simulations
+        :type quantiles: tuple
+        :return: Dictionary with the counts of all simulations ("runs", with shape runs x iterations x groups x
+        states), their mean ("mean") and quantiles ("quantiles", with the quantiles in the first axis)
+        :rtype: dict
+        """
+        global _batch
+        self.batch.save_initial_state()
+        seeds = numpy.random.SeedSequence(seed).spawn(runs)
+        tasks = [(s, steps, group, infected) for s in seeds]
+
+        _batch = self.batch
+        try:
+            with multiprocessing.get_context("fork").Pool(processes=self.processes) as pool:
+                results = pool.map(_run_simulation, tasks)
+        finally:
+            _batch = None
+
+        counts = numpy.stack(results)
+        return {"groups": list(self.batch.groups),
+                "states": list(BatchRun.STATES),
+                "runs": counts,
+                "mean": counts.mean(axis=0),
+                "q": list(quantiles),
+                "quantiles": numpy.quantile(counts, quantiles, axis=0)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run many simulations of the contamination spreading on a pool of "
+                                                 "processes and write the mean and quantiles of the number of "
+                                                 "vertices on each state per step.")
+    parser.add_argument("-r", "--runs", type=int, default=100, help="number of simulations")
+    parser.add_argument("-n", "--steps", type=int, default=100, help="number of SER steps of each simulation")
+    parser.add_argument("-g", "--group", default=None, help="Tc group of the initial infection (default: first one)")
+    parser.add_argument("-i", "--infected", type=int, default=1, help="number of vertices infected at the start")
+    parser.add_argument("-p", "--processes", type=int, default=None, help="number of worker processes")
+    parser.add_argument("-s", "--seed", type=int, default=None, help="seed of the ensemble")
+    parser.add_argument("-q", "--quantiles", type=float, nargs="+", default=[0.05, 0.5, 0.95],
+                        help="quantiles to be calculated")
+    parser.add_argument("-o", "--output", default=None, help="CSV file to write the results (default: stdout)")
+    parser.add_argument("--shapefile", default="shapefile/clipabaetetubasolo.shp", help="shapefile of the habitats")
+    parser.add_argument("--no-cache", action="store_true", help="generate the graph again instead of loading it "
+                                                                "from the cache")
+    args = parser.parse_args(argv)
+
+    batch = BatchRun.CBatchRun(sf=args.shapefile, use_cache=not args.no_cache)
+    batch.gen_graph()
+    group = args.group if args.group is not None else batch.groups[0]
+
+    start = time.time()
+    result = CEnsemble(batch, processes=args.processes).run(runs=args.runs,
+                                                            steps=args.steps,
+                                                            group=group,
+                                                            infected=args.infected,
+                                                            seed=args.seed,
+                                                            quantiles=args.quantiles)
+    print("%d simulations in %.2f s" % (args.runs, time.time() - start), file=sys.stderr)
+
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        writer = csv.writer(output)
+        writer.writerow(["iteration", "group", "state", "mean"] + ["q%g" % q for q in result["q"]])
+        for iteration in range(args.steps + 1):
+            for i, grp in enumerate(result["groups"]):
+                for j, state in enumerate(result["states"]):
+                    writer.writerow([iteration, grp, state, result["mean"][iteration, i, j]] +
+                                    [q[iteration, i, j] for q in result["quantiles"]])
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
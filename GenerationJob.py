@@ -0,0 +1,94 @@
+# coding=utf-8
+import threading
+import time
+
+
+class CGenerationJob:
+    """This class builds the environment graph on a thread of its own, so the interface is not frozen while the
+    vertices and edges are calculated. The graph is only changed at the end, by commit_graph called on the thread of
+    the interface. Progress and the end of the job are reported through a dispatch function, like GLib.idle_add, that
+    calls them on the thread of the interface."""
+
+    def __init__(self, env_graph, dispatch, on_progress=None, on_done=None, previous=None, progress_interval=0.1):
+        """
+        :param env_graph: Environment graph to be generated
+        :type env_graph: test_graph.CEnvironmentGraph
+        :param dispatch: Function that schedules a call as dispatch(function, *args) on the thread of the interface
+        :type dispatch: function
+        :param on_progress: Function called as on_progress(stage, done, total), where stage is "shapes", "vertices" or
+        "edges"
+        :type on_progress: function
+        :param on_done: Function called as on_done(committed) at the end of the job, with committed False when the job
+        was cancelled
+        :type on_done: function
+        :param previous: Job started before this one. It must be cancelled, this job waits for it to finish
+        :type previous: CGenerationJob
+        :param progress_interval: Minimum time in seconds between two progress reports of the same stage
+        :type progress_interval: float
+        """
+        self.env_graph = env_graph
+        self.dispatch = dispatch
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.previous = previous
+        self.progress_interval = progress_interval
+        self.last_report = {}  # Time of the last progress report of each stage
+        self.cancel_event = threading.Event()
+        self.finished = False  # Set on the thread of the interface, after the graph is replaced
+        self.thread = None
+
+    def start(self):
+        """Start building the graph on a new thread"""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        """Ask the job to stop. The graph is not changed by a cancelled job"""
+        self.cancel_event.set()
+
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    def is_finished(self):
+        return self.finished
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        """Build the graph and dispatch its commit to the thread of the interface"""
+        if self.previous is not None:
+            # The jobs share the attributes of the environment graph used while building, so they can not overlap
+            self.previous.join()
+            self.previous = None
+        plan = None
+        try:
+            if not self.is_cancelled():
+                plan = self.env_graph.build_graph(progress=self.report, cancelled=self.is_cancelled)
+        finally:
+            self.dispatch(self.finish, plan)
+
+    def report(self, stage, done, total):
+        """Dispatch a progress report, skipping the reports that come too fast to be seen"""
+        now = time.monotonic()
+        if done < total and now - self.last_report.get(stage, 0) < self.progress_interval:
+            return
+        self.last_report[stage] = now
+        self.dispatch(self.show_progress, stage, done, total)
+
+    def show_progress(self, stage, done, total):
+        """Call on_progress on the thread of the interface, unless the job was cancelled"""
+        if self.on_progress is not None and not self.is_cancelled():
+            self.on_progress(stage, done, total)
+        return False
+
+    def finish(self, plan):
+        """Replace the graph by the one built, on the thread of the interface, and call on_done"""
+        committed = plan is not None and not self.is_cancelled()
+        if committed:
+            self.env_graph.commit_graph(plan)
+        self.finished = True
+        if self.on_done is not None:
+            self.on_done(committed)
+        return False
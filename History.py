@@ -0,0 +1,87 @@
+# coding=utf-8
+import numpy
+
+
+class CHistory:
+    """This class store the changes made by each step of the simulation, so it can be undone. Instead of saving the
+    state of all vertices on every step, only the vertices that operated and the states they lost are recorded, with a
+    complete checkpoint saved periodically."""
+
+    def __init__(self, checkpoint_interval=1000):
+        self.checkpoint_interval = checkpoint_interval
+        self.steps = []  # One record for each iteration, with the operating vertices and the states changed
+        self.checkpoints = {}  # Complete state of the simulation on some iterations
+
+    def clear(self):
+        """Discard all the steps and checkpoints saved"""
+        self.steps = []
+        self.checkpoints = {}
+
+    def is_checkpoint(self, iteration):
+        """Verify if a checkpoint should be saved on the iteration"""
+        return iteration % self.checkpoint_interval == 0
+
+    def add_checkpoint(self, iteration, checkpoint):
+        """Save the complete state of the simulation on the iteration"""
+        self.checkpoints[iteration] = checkpoint
+
+    def get_checkpoint(self, iteration):
+        """Return the checkpoint saved on the iteration, or None if there is no one"""
+        return self.checkpoints.get(iteration)
+
+    def next_checkpoint(self, iteration):
+        """Return the first iteration with a checkpoint saved at or after the iteration, or None if there is no one"""
+        following = [i for i in self.checkpoints if i >= iteration]
+        if following:
+            return min(following)
+        return None
+
+    def last_iteration(self):
+        """Return the iteration reached by the last step recorded"""
+        return len(self.steps)
+
+    def truncate(self, iteration):
+        """
+        Discard the steps and checkpoints after the iteration. It must be called before a step forward, because the
+        steps previously saved after it are not valid anymore.
+        :param iteration: The iteration where the simulation is
+        :type iteration: int
+        :return: None
+        :rtype: None
+        """
+        del self.steps[iteration:]
+        for i in [i for i in self.checkpoints if i > iteration]:
+            del self.checkpoints[i]
+
+    def record(self, iteration, operating, changes):
+        """
+        Save the changes made by a step forward.
+        :param iteration: The iteration where the step started
+        :type iteration: int
+        :param operating: Indexes of the vertices that operated on the step
+        :type operating: list
+        :param changes: Arrays with the vertices, group indexes and old state codes, in the order they were changed
+        :type changes: tuple
+        :return: None
+        :rtype: None
+        """
+        self.truncate(iteration)
+        vertices, indexes, states = changes
+        self.steps.append((numpy.array(operating, dtype=numpy.int32),
+                           numpy.array(vertices, dtype=numpy.int32),
+                           numpy.array(indexes, dtype=numpy.int16),
+                           numpy.array(states, dtype=numpy.uint8)))
+
+    def get_step(self, iteration):
+        """
+        Return the record of the step that started on the iteration.
+        :param iteration: The iteration where the step started
+        :type iteration: int
+        :return: Arrays with the operating vertices, and the vertices, group indexes and old states of each change
+        :rtype: tuple
+        """
+        return self.steps[iteration]
+
+    def has_step(self, iteration):
+        """Verify if the step that started on the iteration was recorded"""
+        return 0 <= iteration < len(self.steps)
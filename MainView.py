@@ -1,16 +1,18 @@
 # coding=utf-8
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, Gio, Gdk, GObject
+from gi.repository import Gtk, Gio, Gdk, GLib
 from graph_tool.all import *
 
+import Compartments
 import Control
 import UpdateSpecies
 import UpdateConnections
 import gtk_graph_draw
-import threading
 import time
 
+FRAME_INTERVAL = 16  # Time in milliseconds between two frames drawn while the simulation runs continuously
+
 class CMainWindow(Gtk.Window):
     """This class is responsable for create the main window of the application. All the containers, box and buttons
     are instaciated here."""
@@ -23,6 +25,8 @@ class CMainWindow(Gtk.Window):
         self.graph = self.ctrl.get_graph()
         self.graph_widget = None
         self.is_running = False  # Attribute to control thread activity
+        self.steps_per_second = None  # Steps achieved by the simulation thread, measured while it runs
+        self.rate_sample = None  # Time and number of steps of the thread at the start of the measurement
         
         # Program main window.
         Gtk.Window.__init__(self, title="CSA") # CSA - Contamination Spreading Analyser
@@ -107,6 +111,7 @@ class CMainWindow(Gtk.Window):
         self.scale.set_draw_value(False)
         self.scale.set_value(40)
         self.scale.set_hexpand(True)
+        self.scale.connect("value-changed", self.on_speed_changed)
 
         # Add icon to scale
         scl_img = Gtk.Image.new_from_file("icons/speed.png")
@@ -116,6 +121,11 @@ class CMainWindow(Gtk.Window):
         scl_box.pack_start(scl_img, False, False, 0)
         scl_box.pack_start(self.scale, True, True, 0)
 
+        # Toggle button to run the simulation as fast as possible, showing only the latest step on each frame
+        self.max_speed_btn = Gtk.ToggleButton(label="Max")
+        self.max_speed_btn.connect("toggled", self.on_speed_changed)
+        scl_box.pack_start(self.max_speed_btn, False, False, 0)
+
         # Button that allow change the state of random species to infected
         infect_btn = Gtk.Button(label='Infect')
         infect_btn.connect("clicked", self.infect)
@@ -272,7 +282,6 @@ class CMainWindow(Gtk.Window):
                                                                     bg_color=[1, 1, 1, 0],
                                                                     bg_image=self.sf    #Only shapefiles are accepted
                                                                     )
-        self.graph_widget.connect("size_allocate", self.size_allocate)
         self.graph_widget.connect("button-release-event", self.button_release_event)
         self.page_environment.add_overlay(self.graph_widget)
         # self.page_environment.set_overlay_pass_through(self.graph_widget, True)
@@ -292,26 +301,22 @@ class CMainWindow(Gtk.Window):
         self.context_id = self.sb.get_context_id("__iteration__")
         self.vert_box.pack_end(self.sb, False, False, 0)
 
-    def size_allocate(self, da, allocation):
-        """Update the graph widget dimensions and send to EnvironmentGraph class"""
-        self.graph_widget_width = allocation.width
-        self.graph_widget_height = allocation.height
-        self.widget_pos_x, self.widget_pos_y = Gtk.Widget.translate_coordinates(self.graph_widget,
-                                                                                Gtk.Widget.get_toplevel(self),
-                                                                                0,
-                                                                                0)
-        self.ctrl.update_widget_dim(self.graph_widget_width,
-                                    self.graph_widget_height,
-                                    self.widget_pos_x,
-                                    self.widget_pos_y)
-
     def generate_graph(self, widget):
-        t = threading.Thread(target=self.thread_gen_graph)
-        t.start()
-
-    def thread_gen_graph(self):
-        self.ctrl.gen_graph()
-        self.redraw()
+        """Start generating the graph on the background. A generation already in progress is cancelled"""
+        if not self.is_running:
+            self.ctrl.start_generation(dispatch=GLib.idle_add,
+                                       on_progress=self.on_generation_progress,
+                                       on_done=self.on_generation_done)
+
+    def on_generation_progress(self, stage, done, total):
+        """Show on the status bar the progress of the graph generation"""
+        stages = {"shapes": "Shapes processed", "vertices": "Vertices placed", "edges": "Edges built"}
+        self.sb.push(self.context_id, "Generating graph... " + stages[stage] + ": " + str(done) + "/" + str(total))
+
+    def on_generation_done(self, committed):
+        """Draw the graph generated, unless the generation was cancelled"""
+        if committed:
+            self.redraw()
 
     def update_combobox(self):
         """Add items to group combobox on toolbar of the MainView"""
@@ -332,46 +337,102 @@ class CMainWindow(Gtk.Window):
         if self.nb.get_current_page() == 0:
             self.graph_widget.key_press_event(self.graph_widget, event=event)
 
-    def redraw(self):
-        """Redraw the graph in environment page and show the number of iterations executed by the SER simulation"""
-        self.graph_widget.regenerate_surface(reset=True)
+    def redraw(self, dirty=None, iteration=None):
+        """
+        Redraw the graph in environment page and show the number of iterations executed by the SER simulation
+        :param dirty: Vertices changed since the last redraw, or None to draw the whole graph again
+        :type dirty: numpy.ndarray
+        :param iteration: Iteration shown by the graph, or None if it is the current iteration of the simulation
+        :type iteration: int
+        :return: None
+        :rtype: None
+        """
+        if dirty is None:
+            self.graph_widget.regenerate_surface(reset=True)
+        else:
+            self.graph_widget.redraw_vertices(dirty)
         self.graph_widget.queue_draw()
+        if iteration is None:
+            iteration = self.ctrl.get_iterations()
+        if self.max_speed_btn.get_active():
+            speed = "Max   "
+        else:
+            speed = str(round(self.scale.get_value(), 0)) + "%   "
+        if self.is_running and self.steps_per_second is not None:
+            speed += "Steps/s: " + str(round(self.steps_per_second, 1)) + "   "
         self.sb.push(self.context_id,
-                     "Iteration: " + str(self.ctrl.get_iterations()) + "   " +
-                     "Speed: " + str(round(self.scale.get_value(), 0)) + "%   ")
+                     "Iteration: " + str(iteration) + "   " +
+                     "Speed: " + speed)
 
     def step_backward(self, widget):
         """Execute one step backward in SER simulation"""
         if not self.is_running:
             self.graph = self.ctrl.step_backward(graph=self.graph,
                                                  group_observed=self.group_combo.get_active_text())
-            self.redraw()
+            self.redraw(self.ctrl.get_dirty_vertices())
 
     def step_forward(self, widget):
         """Execute one step forward in SER simulation"""
         if not self.is_running:
             self.graph = self.ctrl.step_forward(graph=self.graph,
                                                 group_observed=self.group_combo.get_active_text())
-            self.redraw()
+            self.redraw(self.ctrl.get_dirty_vertices())
 
     def run_continuously(self, widget):
-        """Start a thread to run step forward continuously"""
+        """Start a thread to run step forward continuously, with the frames it produces drawn periodically"""
+        if self.ctrl.is_generating():
+            return
         if not self.is_running:
             self.is_running = True
-            t = threading.Thread(target=self.threaded_step_forward)
-            t.start()
+            self.steps_per_second = None
+            self.rate_sample = (time.monotonic(), 0)
+            interval, frame_interval = self.get_simulation_intervals()
+            self.ctrl.start_simulation(graph=self.graph, interval=interval, frame_interval=frame_interval)
+            GLib.timeout_add(FRAME_INTERVAL, self.show_frame)
             self.run_and_stop_btn.set_image(Gtk.Image.new_from_file("icons/stop.png"))
         else:
-            self.is_running = False
+            # The simulation is considered running until show_frame draws the last step of the thread
+            self.ctrl.stop_simulation()
             self.run_and_stop_btn.set_image(Gtk.Image.new_from_file("icons/run.png"))
 
-    def threaded_step_forward(self):
-        """Execute step forward continuously in SER simulation inside a thread"""
-        while self.is_running:
-            self.graph = self.ctrl.step_forward(graph=self.graph,
-                                                group_observed=self.group_combo.get_active_text())
-            GObject.idle_add(self.redraw)
-            time.sleep(3 / self.scale.get_value())
+    def show_frame(self):
+        """Draw the newest frame produced by the simulation thread. It is called by GLib every FRAME_INTERVAL
+        milliseconds and returns False to be removed when the thread has stopped"""
+        self.measure_steps_per_second()
+        update = self.ctrl.update_from_frames(graph=self.graph, group_observed=self.group_combo.get_active_text())
+        if update is None:
+            return True
+        iteration, dirty = update
+        self.redraw(dirty, iteration=iteration)
+        if dirty is None:
+            self.is_running = False
+            return False
+        return True
+
+    def measure_steps_per_second(self):
+        """Update the number of steps per second achieved by the simulation thread, measured over the last second"""
+        now, steps = time.monotonic(), self.ctrl.get_simulation_steps()
+        start, start_steps = self.rate_sample
+        if now - start >= 1:
+            self.steps_per_second = (steps - start_steps) / (now - start)
+            self.rate_sample = (now, steps)
+
+    def get_simulation_intervals(self):
+        """
+        Return the time between the start of two steps of the simulation thread, accordingly to the speed scale, and
+        the minimum time between two frames produced by it. On max speed the steps are not delayed and the frames are
+        produced only as often as they are drawn.
+        :return: Both intervals, in seconds
+        :rtype: tuple
+        """
+        if self.max_speed_btn.get_active():
+            return 0.0, FRAME_INTERVAL / 1000
+        return 3 / self.scale.get_value(), 0.0
+
+    def on_speed_changed(self, widget):
+        """Change the intervals of the simulation thread when the speed scale or the max speed button change"""
+        interval, frame_interval = self.get_simulation_intervals()
+        self.ctrl.set_simulation_interval(interval=interval, frame_interval=frame_interval)
 
     def reset(self, widget):
         """Reset the SER simulation"""
@@ -414,7 +475,8 @@ class CMainWindow(Gtk.Window):
             selected_vertex_props["spread_model"] = self.graph.vertex_properties.spread_model[v]
             selected_vertex_props["group"] = self.graph.vertex_properties.group[v]
             selected_vertex_props["habitat"] = self.graph.vertex_properties.habitat[v]
-            selected_vertex_props["state"] = self.graph.vertex_properties.state[v]
+            selected_vertex_props["state"] = Compartments.CCompartments.of_graph(self.graph).get_vertex_states(
+                v, self.graph.vertex_properties.group[v])
             neighbor_dct = {}
             for n in self.graph.get_in_neighbors(v):
                 self.add_especies_to_dct(dct=neighbor_dct, v=n)
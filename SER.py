@@ -1,81 +1,287 @@
 # coding=utf-8
 from graph_tool.all import *
+import numpy
 import SpreadModels
 import SaveData
+import History
+import Compartments
 
 class CSER:
     """This class is responsible for implement the Scheduling by Edge Reversal algorithm and control the simulation."""
 
-    def __init__(self):
-        self.sm = SpreadModels.CSIR()
+    def __init__(self, seed=None):
+        self.sm = SpreadModels.CSIR(seed=seed)
         self.sinks = []
         self.iterations = 0
-        self.vertex_states = {}
+        self.history = History.CHistory()
         self.sv = SaveData.CSaveData()
 
+        # The orientation of the edges is kept as a NumPy array, with one [source, target] row for each undirected
+        # edge of the graph, so a SER step is done with masked array operations instead of adding and removing edges
+        # of the graph_tool.Graph. The graph is only updated by sync_graph when it needs to be drawn.
+        self.graph = None
+        self.compartments = None
+        self.num_vertices = 0
+        self.edges = numpy.zeros((0, 2), dtype=numpy.int64)
+        self.neighbors = numpy.zeros(0, dtype=numpy.int64)  # Neighbors of all vertices, grouped by vertex
+        self.neighbors_edge = numpy.zeros(0, dtype=numpy.int64)  # Row in self.edges connecting to each neighbor
+        self.neighbors_ptr = numpy.zeros(1, dtype=numpy.int64)  # Position of each vertex neighbors in self.neighbors
+        self.is_synced = True
+        # Vertices which color or incident edges changed on the last step, or None if any vertex could have changed
+        self.dirty = None
+
+        # Degree counters and the live sets of sinks and sources. They are updated only for the vertices touched by
+        # the last reversal, so the cost of a step depends on the number of operating vertices, not the graph size.
+        self.degree = numpy.zeros(0, dtype=numpy.int64)
+        self.out_degree = numpy.zeros(0, dtype=numpy.int64)
+        self.sink_set = set()
+        self.source_set = set()
+
     def get_iterations_number(self):
         return self.iterations
 
-    def run(self, g, is_forward, go):
-        """Verify if is a forward or backward step and revert the edges accordingly to each movement"""
+    def seed(self, seed):
+        """Restart the stream of random numbers used to spread the infection from a seed"""
+        self.sm.seed(seed)
+
+    def load_graph(self, graph):
+        """
+        Read the edges of the graph to the orientation array and build the neighbors list of each vertex.
+        :param graph: Graph used on simulation
+        :type graph: graph_tool.Graph
+        :return: None
+        :rtype: None
+        """
+        self.graph = graph
+        self.compartments = Compartments.CCompartments.of_graph(graph)
+        self.num_vertices = graph.num_vertices()
+        edges = numpy.asarray(graph.get_edges(), dtype=numpy.int64).reshape(graph.num_edges(), -1)
+        self.edges = numpy.array(edges[:, :2])
+
+        # Each undirected edge is seen from both of its endpoints. Sorting by the endpoint groups the neighbors of
+        # each vertex, so the neighbors of v are self.neighbors[self.neighbors_ptr[v]:self.neighbors_ptr[v + 1]]
+        ends = numpy.concatenate((self.edges[:, 0], self.edges[:, 1]))
+        others = numpy.concatenate((self.edges[:, 1], self.edges[:, 0]))
+        edge_index = numpy.tile(numpy.arange(len(self.edges)), 2)
+        order = numpy.argsort(ends, kind="stable")
+        self.neighbors = others[order]
+        self.neighbors_edge = edge_index[order]
+        self.degree = numpy.bincount(ends, minlength=self.num_vertices)
+        self.neighbors_ptr = numpy.zeros(self.num_vertices + 1, dtype=numpy.int64)
+        numpy.cumsum(self.degree, out=self.neighbors_ptr[1:])
+
+        self.set_orientation(self.edges)
+
+        self.sinks = []
+        self.iterations = 0
+        self.history.clear()
+        self.is_synced = True
+        self.dirty = None
+
+    def set_orientation(self, edges):
+        """Replace the edges orientation and count again the degrees, sinks and sources of all vertices"""
+        self.edges = numpy.array(edges, dtype=numpy.int64)
+        self.out_degree = numpy.bincount(self.edges[:, 0], minlength=self.num_vertices)
+        self.sink_set = set()
+        self.source_set = set()
+        self.update_sinks(numpy.arange(self.num_vertices))
+        self.is_synced = False
+
+    def check_graph(self, graph):
+        """Load the graph again if it is not the one used on the last steps or if it was regenerated"""
+        if graph is not self.graph or graph.num_vertices() != self.num_vertices or \
+                graph.num_edges() != len(self.edges) or \
+                Compartments.CCompartments.of_graph(graph) is not self.compartments:
+            self.load_graph(graph)
+
+    def sync_graph(self, graph):
+        """
+        Write the edges orientation back to the graph, so the graph can be drawn.
+        :param graph: Graph used on simulation
+        :type graph: graph_tool.Graph
+        :return: The graph with the edges oriented as in the last SER step
+        :rtype: graph_tool.Graph
+        """
+        if graph is self.graph and not self.is_synced:
+            graph.clear_edges()
+            graph.add_edge_list(self.edges)
+            self.is_synced = True
+        return graph
+
+    def get_neighbors(self, v):
+        """Return the indexes of all vertices connected to v, regardless of the edges orientation"""
+        return self.neighbors[self.neighbors_ptr[v]:self.neighbors_ptr[v + 1]]
+
+    def gather_neighbors(self, vertices):
+        """
+        Gather the neighbors of a list of vertices at once.
+        :param vertices: Indexes of the vertices
+        :type vertices: list
+        :return: Three arrays with one item for each pair of connected vertices: the vertex from the list, its
+        neighbor and the row of self.edges that connects them
+        :rtype: tuple
+        """
+        vertices = numpy.asarray(vertices, dtype=numpy.int64)
+        starts = self.neighbors_ptr[vertices]
+        counts = self.neighbors_ptr[vertices + 1] - starts
+        # Position of each neighbor in self.neighbors: the start of its vertex block plus its offset inside the block
+        offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        positions = numpy.repeat(starts, counts) + offsets
+        return numpy.repeat(vertices, counts), self.neighbors[positions], self.neighbors_edge[positions]
+
+    def update_sinks(self, vertices):
+        """Update the sets of sinks and sources, checking only the vertices which degrees could have changed"""
+        vertices = numpy.unique(vertices)
+        degree = self.degree[vertices]
+        out_degree = self.out_degree[vertices]
+        is_sink = (degree > 0) & (out_degree == 0)
+        is_source = (degree > 0) & (out_degree == degree)
+
+        self.sink_set.difference_update(vertices[~is_sink].tolist())
+        self.sink_set.update(vertices[is_sink].tolist())
+        self.source_set.difference_update(vertices[~is_source].tolist())
+        self.source_set.update(vertices[is_source].tolist())
+
+    def run(self, g, is_forward, go, check=True):
+        """Verify if is a forward or backward step and revert the edges accordingly to each movement. The graph edges
+        are not updated here, use sync_graph before draw it. With check False the graph is assumed to be the one
+        loaded, even if its edges changed."""
+        if check:
+            self.check_graph(g)
         if is_forward:
-            self.concurrency_measure(g)
-            self.save_vertex_state(graph=g)
+            self.history.truncate(self.iterations)
+            if self.history.is_checkpoint(self.iterations):
+                self.save_vertex_state(graph=g)
+            self.concurrency_measure()
+            self.revert_edge(is_forward=True)
+            changes = self.spread_infection(graph=g, group_observed=go)
+            self.history.record(self.iterations, self.sinks, changes)
             self.iterations += 1
+            self.dirty = self.step_vertices(self.iterations - 1)
         elif self.iterations > 0:
-            self.identify_last_sinks(g)
+            if self.iterations == self.history.last_iteration() and \
+                    self.history.get_checkpoint(self.iterations) is None:
+                # Keep the state of the last iteration simulated, so it is possible to seek back to it
+                self.save_vertex_state(graph=g)
             self.iterations -= 1
-
-        self.revert_edge(graph=g, is_forward=is_forward)
-        self.spread_infection(graph=g, is_forward=is_forward, group_observed=go)
+            self.identify_last_sinks()
+            self.revert_edge(is_forward=False)
+            self.restore_infection(graph=g, group_observed=go)
+            self.dirty = self.step_vertices(self.iterations)
+        else:
+            self.dirty = numpy.zeros(0, dtype=numpy.int64)
         return g
 
+    def step_vertices(self, iteration):
+        """Return the vertices that operated or changed their state on the step that started on the iteration"""
+        operating, vertices, indexes, states = self.history.get_step(iteration)
+        return numpy.unique(numpy.concatenate((operating, vertices)).astype(numpy.int64))
+
+    def get_dirty_vertices(self):
+        """
+        Return the vertices that must be drawn again after the last step: the vertices that operated, which had all
+        their edges reverted, and the vertices which state changed.
+        :return: Indexes of the vertices, or None if the last change was not a single step and the whole graph must
+        be drawn again
+        :rtype: numpy.ndarray
+        """
+        return self.dirty
+
     def reset(self, g, go):
-        """Runs the SER algorithm backwards until it reaches the initial state"""
-        while self.iterations:
+        """Return the simulation to the initial state, restoring the checkpoint saved on the first iteration"""
+        return self.seek(g=g, go=go, iteration=0)
+
+    def seek(self, g, go, iteration):
+        """
+        Go directly to an iteration of the simulation. The nearest checkpoint at or after the iteration is restored
+        and the steps between them are undone, so the cost does not depend on how far the simulation is. Iterations
+        after the last one simulated are reached running steps forward.
+        :param g: Graph that handle the species on simulation
+        :type g: graph_tool.Graph
+        :param go: Tc group that is being observed by the user
+        :type go: str
+        :param iteration: The iteration to go
+        :type iteration: int
+        :return: The graph on the iteration
+        :rtype: graph_tool.Graph
+        """
+        self.check_graph(g)
+        iteration = max(0, iteration)
+        last_iteration = self.history.last_iteration()
+        if iteration > last_iteration:
+            g = self.seek(g=g, go=go, iteration=last_iteration)
+            while self.iterations < iteration:
+                g = self.run(g=g, is_forward=True, go=go)
+            self.dirty = None
+            return g
+
+        if iteration == self.iterations:
+            self.dirty = None
+            return g
+        if self.iterations == last_iteration and self.history.get_checkpoint(last_iteration) is None:
+            # Keep the state of the last iteration simulated, so it is possible to seek back to it
+            self.save_vertex_state(graph=g)
+
+        checkpoint = self.history.next_checkpoint(iteration)
+        if checkpoint is not None and (iteration > self.iterations or checkpoint < self.iterations):
+            self.restore_vertex_state(graph=g, iteration=checkpoint)
+        while self.iterations > iteration:
             g = self.run(g=g, is_forward=False, go=go)
+        self.dirty = None
         return g
 
     def save_vertex_state(self, graph):
-        states = {}
-        for v in graph.vertices():
-            states[graph.vertex_index[v]] = list(graph.vertex_properties.state[v])
-        self.vertex_states[self.iterations] = states
+        """Save a checkpoint with the state of all vertices and the edges orientation on the current iteration"""
+        self.history.add_checkpoint(self.iterations, (self.compartments.state.copy(), self.edges.copy()))
 
-    def concurrency_measure(self, graph):
-        """Identify the vertices that are sink in this moment and create a list with they indexes."""
+    def restore_vertex_state(self, graph, iteration):
+        """
+        Restore the state of all vertices and the edges orientation from a checkpoint.
+        :param graph: Graph that handle the species on simulation
+        :type graph: graph_tool.Graph
+        :param iteration: Iteration where the checkpoint was saved
+        :type iteration: int
+        :return: None
+        :rtype: None
+        """
+        state, edges = self.history.get_checkpoint(iteration)
+        self.compartments.state[...] = state
+        self.set_orientation(edges)
         self.sinks = []
-        for v in graph.vertices():
-            if (v.in_degree() > 0) and (v.out_degree() == 0):
-                self.sinks.append(graph.vertex_index[v])
+        self.iterations = iteration
+
+    def concurrency_measure(self):
+        """Identify the vertices that are sink in this moment and create a list with they indexes."""
+        self.sinks = sorted(self.sink_set)
 
-    def identify_last_sinks(self, graph):
+    def identify_last_sinks(self):
         """Identify the vertices that operated in the last iteration and create a list with they indexes."""
-        self.sinks = []
-        for v in graph.vertices():
-            if (v.out_degree() > 0) and (v.in_degree() == 0):
-                self.sinks.append(graph.vertex_index[v])
+        if self.history.has_step(self.iterations):
+            self.sinks = self.history.get_step(self.iterations)[0].tolist()
+        else:
+            self.sinks = sorted(self.source_set)
 
-    def revert_edge(self, graph, is_forward):
+    def revert_edge(self, is_forward):
         """Revert all edges of all vertices in self.sinks list, regarding as a step forward or backward"""
-        for sink in self.sinks:
-            if is_forward:
-                neighbors_list = graph.get_in_neighbors(sink)
-            else:
-                neighbors_list = graph.get_out_neighbors(sink)
-
-            for neighbor in neighbors_list:
-                if is_forward:
-                    old_edge = graph.edge(neighbor, sink)
-                    new_edge = graph.add_edge(sink, neighbor)
-                else:
-                    old_edge = graph.edge(sink, neighbor)
-                    new_edge = graph.add_edge(neighbor, sink)
-
-                # eprop_criterio = graph.edge_properties["contaminationCriteria"]
-                # eprop_criterio[(new_edge.source(), new_edge.target())] = eprop_criterio[(old_edge.source(), old_edge.target())]
-                # graph.edge_properties["contaminationCriteria"] = eprop_criterio
-                graph.remove_edge(old_edge)
+        if not self.sinks:
+            return
+        vertices, neighbors, edges = self.gather_neighbors(self.sinks)
+
+        # On a step forward the sinks have only incoming edges, which become outgoing. On a step backward the last
+        # sinks have only outgoing edges, which become incoming.
+        if is_forward:
+            self.edges[edges, 0] = vertices
+            self.edges[edges, 1] = neighbors
+            self.out_degree[self.sinks] = self.degree[self.sinks]
+            numpy.subtract.at(self.out_degree, neighbors, 1)
+        else:
+            self.edges[edges, 0] = neighbors
+            self.edges[edges, 1] = vertices
+            self.out_degree[self.sinks] = 0
+            numpy.add.at(self.out_degree, neighbors, 1)
+
+        self.update_sinks(numpy.concatenate((self.sinks, neighbors)))
+        self.is_synced = False
 
     def random_infect_specie(self, graph, group):
         """
@@ -90,25 +296,38 @@ class CSER:
         """
         self.sm.random_infect(g=graph, grp=group)
 
-    def spread_infection(self, graph, is_forward, group_observed):
+    def spread_infection(self, graph, group_observed):
         """
         Spread the infection from source vertices to their neighbors after revert the edges using SER algorithm
         :param graph: Graph that handle the species on simulation
         :type graph: graph_tool.Graph
-        :param is_forward: Define if the simulation is running a step forward or backward
-        :type is_forward: bool
+        :param group_observed: Tc group that is being observed by the user
+        :type str
+        :return: Arrays with the vertices, group indexes and old states of the states changed
+        :rtype: tuple
+        """
+        # All edges of a vertex that operated were reverted, so all its neighbors are out neighbors
+        sources, targets, edges = self.gather_neighbors(self.sinks)
+        return self.sm.infect(graph=graph,
+                              compartments=self.compartments,
+                              group_observed=group_observed,
+                              sources=sources,
+                              targets=targets)
+
+    def restore_infection(self, graph, group_observed):
+        """
+        Undo the changes of states made by the step that started on the current iteration
+        :param graph: Graph that handle the species on simulation
+        :type graph: graph_tool.Graph
         :param group_observed: Tc group that is being observed by the user
         :type str
         :return: None
         :rtype: None
         """
-        for source in self.sinks:  # After revert edges the sinks become sources
-            count = len(graph.vertex_properties.group[source])
-            for index in range(0, count):
-                self.sm.infect(graph=graph,
-                               group_observed=group_observed,
-                               index=index,
-                               source=source,
-                               is_forward=is_forward,
-                               vertex_states=self.vertex_states,
-                               iteration=self.iterations)
+        operating, vertices, indexes, states = self.history.get_step(self.iterations)
+        self.sm.restore(graph=graph,
+                        compartments=self.compartments,
+                        group_observed=group_observed,
+                        vertices=vertices,
+                        indexes=indexes,
+                        states=states)
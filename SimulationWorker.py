@@ -0,0 +1,130 @@
+# coding=utf-8
+import collections
+import queue
+import threading
+import time
+
+import numpy
+
+
+class CFrame(collections.namedtuple("CFrame", ["iteration", "state", "edges"])):
+    """Copy of the simulation after a step: the iteration reached, the matrix of state codes of the compartments and
+    the edges orientation. The arrays are read only, so a frame can be handed from the simulation thread to the
+    interface without being changed by the following steps."""
+    __slots__ = ()
+
+    @classmethod
+    def of_simulation(cls, ser):
+        """
+        Copy the current state of a simulation to a new frame.
+        :param ser: Simulation to be copied
+        :type ser: SER.CSER
+        :return: The frame
+        :rtype: CFrame
+        """
+        state = ser.compartments.state.copy()
+        edges = ser.edges.astype(numpy.int32)
+        state.flags.writeable = False
+        edges.flags.writeable = False
+        return cls(ser.iterations, state, edges)
+
+
+class CSimulationWorker:
+    """This class runs the SER simulation steps on a thread of its own and produces frames of the steps into a
+    bounded queue. The graph drawn by the interface is never changed by the thread: the interface consumes the frames
+    at its own rate, so the cost of drawing does not slow down the simulation. When the queue is full the oldest frame
+    is dropped, the thread never waits for the interface."""
+
+    def __init__(self, ser, graph, lock, interval=0.0, frame_interval=0.0, max_frames=8):
+        """
+        :param ser: Simulation to be run
+        :type ser: SER.CSER
+        :param graph: Graph used on simulation
+        :type graph: graph_tool.Graph
+        :param lock: Lock held while a step runs, so the simulation is not changed by other threads in the middle of it
+        :type lock: threading.Lock
+        :param interval: Time in seconds between the start of two steps, zero to run as fast as possible
+        :type interval: float
+        :param frame_interval: Minimum time in seconds between two frames. Zero produces a frame after each step
+        :type frame_interval: float
+        :param max_frames: Number of frames kept in the queue until they are consumed
+        :type max_frames: int
+        """
+        self.ser = ser
+        self.graph = graph
+        self.lock = lock
+        self.interval = interval
+        self.frame_interval = frame_interval
+        self.steps = 0  # Number of steps run since the thread started
+        self.frames = queue.Queue(maxsize=max_frames)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start running steps forward on a new thread"""
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Ask the thread to stop after the step in progress"""
+        self.stopped.set()
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+
+    def set_interval(self, interval, frame_interval=0.0):
+        """Change the time in seconds between the start of two steps and the minimum time between two frames"""
+        self.interval = interval
+        self.frame_interval = frame_interval
+
+    def run(self):
+        """Run steps forward until stop is called, putting a frame on the queue after each one"""
+        next_frame = time.monotonic()
+        while not self.stopped.is_set():
+            start = time.monotonic()
+            with self.lock:
+                # The colors of the graph are not changed here, they are painted by the interface from the frames
+                # The graph was checked when the simulation started. Its edges are re-oriented by the interface while
+                # the thread runs, so they are not compared again on each step
+                self.ser.run(g=self.graph, is_forward=True, go=None, check=False)
+                self.steps += 1
+                # Copying the arrays costs as much as a step on large graphs, so it is skipped for the steps that
+                # would not be shown
+                frame = None
+                if start >= next_frame:
+                    frame = CFrame.of_simulation(self.ser)
+                    next_frame = start + self.frame_interval
+            if frame is not None:
+                self.put_frame(frame)
+            delay = self.interval - (time.monotonic() - start)
+            if delay > 0:
+                self.stopped.wait(delay)
+            else:
+                # Let the interface thread take the lock between the steps
+                time.sleep(0)
+
+    def put_frame(self, frame):
+        """Put a frame on the queue without waiting, dropping the oldest frames while the queue is full"""
+        while True:
+            try:
+                self.frames.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    self.frames.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def get_frames(self):
+        """Remove and return all the frames on the queue, from the oldest to the newest"""
+        frames = []
+        while True:
+            try:
+                frames.append(self.frames.get_nowait())
+            except queue.Empty:
+                return frames
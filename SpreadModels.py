@@ -1,7 +1,7 @@
 # coding=utf-8
 from graph_tool.all import *
-from numpy.random import *
 import numpy
+import Compartments
 
 _colors_defaults = {
     "S": (186 / 255, 172 / 255, 18 / 255, 0.8),
@@ -12,12 +12,17 @@ _colors_defaults = {
 
 
 class CSIR:
-    def __init__(self):
+    def __init__(self, seed=None):
         # SIRS dynamics parameters:
         self.x = 0.1  # spontaneous outbreak probability
         self.r = 0.001  # I->R probability
         self.s = 0.1  # R->S probability
         self.sinks = []
+        self.rng = numpy.random.default_rng(seed)  # Each simulation has its own stream of random numbers
+
+    def seed(self, seed):
+        """Restart the stream of random numbers used by the spread models from a seed"""
+        self.rng = numpy.random.default_rng(seed)
 
     @staticmethod
     def get_state_color(state):
@@ -33,97 +38,118 @@ class CSIR:
         :return: None
         :rtype: None
         """
-        trials = 0
-        while trials <= g.num_vertices():
-            v_index = randint(0, g.num_vertices() - 1)
-            v = g.vertex(v_index)
-            if grp in g.vertex_properties.group[v]:
-                group_list = list(g.vertex_properties.group[v])
-                index = group_list.index(grp)
-                if g.vertex_properties.state[v][index] is "I":
-                    trials += 1
-                else:
-                    g.vertex_properties.state_color[v] = self.get_state_color("I")
-                    g.vertex_properties.state[v][index] = "I"
-                    break
-            else:
-                trials += 1
+        compartments = Compartments.CCompartments.of_graph(g)
+        index = compartments.get_group_index(grp)
+        if index is None:
+            return
+        # Only the vertices that can be infected by the group and are not infected yet are candidates
+        candidates = numpy.flatnonzero(compartments.eligible[:, index] &
+                                       (compartments.state[:, index] != Compartments.I))
+        if len(candidates) > 0:
+            v = int(candidates[self.rng.integers(0, len(candidates))])
+            compartments.state[v, index] = Compartments.I
+            g.vertex_properties.state_color[v] = self.get_state_color("I")
+
+    def infect(self, graph, compartments, group_observed, sources, targets):
+        """
+        Spread the infection of all Tc groups from the vertices that operated on a step to their out neighbors, with
+        the trials of all edges done at once. Each neighbor follows its own spread model for each group: SI only
+        infects, SIS also gives back the susceptible state with probability self.s and SIR removes the vertex with
+        probability self.r.
+        :param graph: The graph used o simulation
+        :type graph: graph_tool.Graph
+        :param compartments: States of the vertices on the simulation
+        :type compartments: Compartments.CCompartments
+        :param group_observed: Tc group that is being observed by the user
+        :type group_observed: str
+        :param sources: Indexes of the vertices that spread the infection, one for each edge
+        :type sources: numpy.ndarray
+        :param targets: Indexes of the out neighbors of each source
+        :type targets: numpy.ndarray
+        :return: Arrays with the vertices, group indexes and old states of the states changed, in the order they were
+        changed
+        :rtype: tuple
+        """
+        state = compartments.state
+        # One trial for each edge and group, when the source is infected and the neighbor can be infected by the group
+        trials = compartments.eligible[sources] & compartments.eligible[targets] & (state[sources] == Compartments.I)
+        edge, index = numpy.nonzero(trials)
+        v = targets[edge]
+        spread_model = compartments.spread_model[v, index]
+        draws = self.rng.random((len(v), 2))  # Infection and recovery trials
+
+        # The vertices that operated are never neighbors of each other, so their states do not change on the step,
+        # but a neighbor shared by many of them must have its trials done in sequence. The trials are split in rounds,
+        # where each (vertex, group) pair appears at most once, in the same order the edges were gathered.
+        keys = v.astype(numpy.int64) * state.shape[1] + index
+        order = numpy.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        is_first = numpy.ones(len(keys), dtype=bool)
+        is_first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        first = numpy.flatnonzero(is_first)
+        rank = numpy.empty(len(keys), dtype=numpy.int64)
+        rank[order] = numpy.arange(len(keys)) - numpy.repeat(first, numpy.diff(numpy.append(first, len(keys))))
 
-    def infect(self, graph, group_observed, index, source, is_forward, vertex_states, iteration):
-        group = graph.vertex_properties.group[source][index]  # Identify the type of Tc
-        if is_forward:
-            # If is a simulation step forward, than the infection spread from source to out neighbors, respecting the
-            # spread model of each group.
-            neighbors_list = graph.get_out_neighbors(source)
-            for n in neighbors_list:
-                if group in graph.vertex_properties.group[n]:
-                    group_list = list(graph.vertex_properties.group[n])
-                    n_index = group_list.index(group)
-                    is_observed = group_observed == group
-                    if graph.vertex_properties.spread_model[n][n_index] == "SI":
-                        # Infect neighbor using SI model
-                        self.si(graph=graph,
-                                s=source,
-                                v=n,
-                                s_index=index,
-                                v_index=n_index,
-                                is_observed=is_observed)
-                    if graph.vertex_properties.spread_model[n][n_index] == "SIS":
-                        # Infect neighbor using SIS model
-                        self.sis(graph=graph,
-                                 s=source,
-                                 v=n,
-                                 s_index=index,
-                                 v_index=n_index,
-                                 is_observed=is_observed)
-                    if graph.vertex_properties.spread_model[n][n_index] == "SIR":
-                        # Infect neighbor using SIR model
-                        self.sir(graph=graph,
-                                 s=source,
-                                 v=n,
-                                 s_index=index,
-                                 v_index=n_index,
-                                 is_observed=is_observed)
-        else:
-            neighbors_list = graph.get_in_neighbors(source)
-            for n in neighbors_list:
-                if group in graph.vertex_properties.group[n]:
-                    group_list = list(graph.vertex_properties.group[n])
-                    n_index = group_list.index(group)
-                    # If is a simulation step backward, than recover the state of each neighbor on last iteration
-                    states = vertex_states[iteration]
-                    state = states[graph.vertex_index[n]]
-                    graph.vertex_properties.state[n][n_index] = state[n_index]
-                    # Identify the group of Tc observed by the user and change the vertex color accordingly
-                    is_observed = group_observed == group
-                    if is_observed:
-                        graph.vertex_properties.state_color[n] = self.get_state_color(state[n_index])
+        vertices, indexes, states = [], [], []
+        for r in range(int(rank.max()) + 1 if len(rank) else 0):
+            selected = rank == r
+            rv, ri, rm, rd = v[selected], index[selected], spread_model[selected], draws[selected]
+            old = state[rv, ri]
+            new = old.copy()
+            new[(rd[:, 0] < self.x) & (old == Compartments.S)] = Compartments.I
+            new[(rm == Compartments.SIS) & (rd[:, 1] < self.s)] = Compartments.S
+            new[(rm == Compartments.SIR) & (rd[:, 1] < self.r)] = Compartments.R
+            changed = new != old
+            state[rv[changed], ri[changed]] = new[changed]
+            vertices.append(rv[changed])
+            indexes.append(ri[changed])
+            states.append(old[changed])
 
-    def si(self, graph, s, v, s_index, v_index, is_observed):
-        if random() < self.x and graph.vertex_properties.state[s][s_index] == "I" and \
-                graph.vertex_properties.state[v][v_index] == "S":
-            graph.vertex_properties.state[v][v_index] = "I"
-            if is_observed:
-                graph.vertex_properties.state_color[v] = self.get_state_color("I")
+        if not vertices:
+            return (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64),
+                    numpy.zeros(0, dtype=numpy.uint8))
+        vertices = numpy.concatenate(vertices)
+        indexes = numpy.concatenate(indexes)
+        states = numpy.concatenate(states)
 
-    def sis(self, graph, s, v, s_index, v_index, is_observed):
-        if graph.vertex_properties.state[s][s_index] == "I":
-            if random() < self.x and graph.vertex_properties.state[v][v_index] == "S":
-                graph.vertex_properties.state[v][v_index] = "I"
-                if is_observed:
-                    graph.vertex_properties.state_color[v] = self.get_state_color("I")
-            if random() < self.s:
-                graph.vertex_properties.state[v][v_index] = "S"
-                if is_observed:
-                    graph.vertex_properties.state_color[v] = self.get_state_color("S")
+        # Identify the group of Tc observed by the user and change the vertices colors accordingly
+        observed_index = compartments.get_group_index(group_observed)
+        if observed_index is not None:
+            observed = numpy.unique(vertices[indexes == observed_index])
+            for v, code in zip(observed.tolist(), state[observed, observed_index].tolist()):
+                graph.vertex_properties.state_color[v] = self.get_state_color(Compartments.STATES[code])
+        return vertices, indexes, states
+
+    def restore(self, graph, compartments, group_observed, vertices, indexes, states):
+        """
+        Give back to the vertices the states they had before a step forward. When a vertex changed more than once in
+        the step, the first state recorded for it is the one restored.
+        :param graph: The graph used o simulation
+        :type graph: graph_tool.Graph
+        :param compartments: States of the vertices on the simulation
+        :type compartments: Compartments.CCompartments
+        :param group_observed: Tc group that is being observed by the user
+        :type group_observed: str
+        :param vertices: Indexes of the vertices changed, in the order they were changed
+        :type vertices: numpy.ndarray
+        :param indexes: Column of the Tc group changed on the compartments matrices
+        :type indexes: numpy.ndarray
+        :param states: Codes of the states of the vertices before each change
+        :type states: numpy.ndarray
+        :return: None
+        :rtype: None
+        """
+        if len(vertices) == 0:
+            return
+        # numpy.unique returns the position of the first occurrence of each (vertex, group) pair
+        keys = numpy.asarray(vertices, dtype=numpy.int64) * len(compartments.groups) + indexes
+        keys, first = numpy.unique(keys, return_index=True)
+        vertices = numpy.asarray(vertices)[first]
+        indexes = numpy.asarray(indexes)[first]
+        states = numpy.asarray(states)[first]
+        compartments.state[vertices, indexes] = states
 
-    def sir(self, graph, s, v, s_index, v_index, is_observed):
-        if graph.vertex_properties.state[s][s_index] == "I":
-            if random() < self.x and graph.vertex_properties.state[v][v_index] == "S":
-                graph.vertex_properties.state[v][v_index] = "I"
-                if is_observed:
-                    graph.vertex_properties.state_color[v] = self.get_state_color("I")
-            if random() < self.r:
-                graph.vertex_properties.state[v][v_index] = "R"
-                if is_observed:
-                    graph.vertex_properties.state_color[v] = self.get_state_color("R")
+        # Identify the group of Tc observed by the user and change the vertices colors accordingly
+        observed = compartments.get_group_index(group_observed)
+        for v, state in zip(vertices[indexes == observed].tolist(), states[indexes == observed].tolist()):
+            graph.vertex_properties.state_color[v] = self.get_state_color(Compartments.STATES[state])
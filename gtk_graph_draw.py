@@ -127,6 +127,51 @@ class VertexMatrix(object):
                     selected[v] = True
 
 
+class VertexGrid(object):
+    """Grid of the vertex positions used to redraw only the region around some vertices. The cells are as large as
+    the box around a vertex that covers its incident edges, so anything that touches the boxes of the vertices is on
+    their cells or on the adjacent ones. The grid is built with the whole graph, so finding the vertices near the
+    changed ones only touches their cells."""
+
+    def __init__(self, g, pos, margin):
+        """
+        :param g: Graph drawn
+        :type g: graph_tool.Graph
+        :param pos: Positions of the vertices
+        :type pos: graph_tool.VertexPropertyMap
+        :param margin: Distance around a vertex enough to cover its shape and halo
+        :type margin: float
+        """
+        self.g = g
+        self.num_vertices = g.num_vertices()
+        self.pos = pos.get_2d_array([0, 1]).T
+        edges = g.get_edges()
+        reach = numpy.abs(self.pos[edges[:, 0]] - self.pos[edges[:, 1]]).max() if len(edges) > 0 else 0
+        self.reach = reach + margin
+        cells = numpy.floor(self.pos / (2 * self.reach)).astype("int64")
+        cells -= cells.min(axis=0) - 1
+        height = cells[:, 1].max() + 2
+        self.keys = cells[:, 0] * height + cells[:, 1]
+        self.offsets = numpy.array([dx * height + dy for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+        # The vertices sorted by cell, so the vertices of a cell are a slice found with a binary search
+        self.order = numpy.argsort(self.keys, kind="stable")
+        self.sorted_keys = self.keys[self.order]
+        self.filter = g.new_vertex_property("bool", False)
+
+    def get_boxes(self, vertices):
+        """Return the corners of the boxes around the vertices that cover them and their incident edges"""
+        return self.pos[vertices] - self.reach, self.pos[vertices] + self.reach
+
+    def get_near(self, vertices):
+        """Return the vertices on the cells of the vertices and on the cells adjacent to them"""
+        wanted = numpy.unique((self.keys[vertices][:, None] + self.offsets).ravel())
+        low = numpy.searchsorted(self.sorted_keys, wanted, side="left")
+        high = numpy.searchsorted(self.sorted_keys, wanted, side="right")
+        lengths = high - low
+        starts = numpy.repeat(low - (numpy.cumsum(lengths) - lengths), lengths)
+        return self.order[starts + numpy.arange(lengths.sum())]
+
+
 def apply_transforms(g, pos, m):
     m = tuple(m)
     g = GraphView(g, directed=True)
@@ -262,6 +307,14 @@ class GraphWidgetWithBackImage(Gtk.DrawingArea):
         self.tmatrix = cairo.Matrix()  # position to surface
         self.smatrix = cairo.Matrix()  # surface to screen
         self.bgmatrix = cairo.Matrix() # background image matrix
+        self.map_matrix = None  # map coordinates to background image, when the background is a shapefile
+        self.map_origin = None  # corner of the map bounding box, where the map matrix starts
+        self.ink_scale = 1  # factor applied to the sizes of vertices and edges, to draw them in map coordinates
+        self.shapes_paths = None  # cairo paths and colors of the shapes already drawn, by shape index
+        self.shapes_paths_key = None
+        self.shapes_layer = None  # shapes rasterized with the background matrix
+        self.shapes_layer_key = None
+        self.shapes_layer_origin = None  # translation of the background matrix when the layer was rasterized
         self.pointer = [0, 0]
         self.picked = False
         self.selected = g.new_vertex_property("bool", False)
@@ -272,6 +325,7 @@ class GraphWidgetWithBackImage(Gtk.DrawingArea):
         self.drag_begin = None
         self.moved_picked = False
         self.vertex_matrix = None
+        self.vertex_grid = None  # positions of the vertices used by redraw_vertices, see update_vertex_grid
         self.fit_view = fit_view
 
         self.display_prop = g.vertex_index if display_props is None \
@@ -370,8 +424,11 @@ class GraphWidgetWithBackImage(Gtk.DrawingArea):
             # Load image to be set as background of GraphWidget
             # self.bg_image = cairo.ImageSurface.create_from_png(self.background)
 
-            # Load the shapefile
-            self.bg_image = shapefile.Reader(self.background)
+            # Load the shapefile. The geometry and the habitat of each shape are decoded only once.
+            self.bg_image = shapefile.Reader(self.background, mmap=True)
+            self.bg_geometry = self.bg_image.geometry()
+            self.bg_levels = {}  # Simplified geometry for each level of detail
+            self.bg_habitat, self.bg_habitats = self.bg_image.columns("LEG_NIVEL2")["LEG_NIVEL2"]
         else:
             self.bg_image = None
 
@@ -402,6 +459,16 @@ class GraphWidgetWithBackImage(Gtk.DrawingArea):
 
             self.top = int((self.widget_height / 2) - (self.img_height * self.scale_xy / 2))
             self.left = int((self.widget_width / 2) - (self.img_width * self.scale_xy / 2))
+
+            # The shapes and the vertex positions are map coordinates. The map is fit inside the image keeping its
+            # aspect ratio, with the y axis pointing up. The matrix starts from the corner of the map bounding box,
+            # the shapes are drawn relative to it.
+            x1, y1, x2, y2 = self.bg_image.bbox[:4]
+            scale = min(self.img_width / (x2 - x1), self.img_height / (y2 - y1))
+            self.map_origin = (x1, y1)
+            self.map_matrix = cairo.Matrix(scale, 0, 0, -scale,
+                                           (self.img_width - (x2 - x1) * scale) / 2,
+                                           (self.img_height + (y2 - y1) * scale) / 2)
         else:
             self.img_height = self.widget_height
             self.img_width = self.widget_width
@@ -415,14 +482,36 @@ class GraphWidgetWithBackImage(Gtk.DrawingArea):
         self.bgmatrix.translate(self.left + self.widget_pos_x, self.top + self.widget_pos_y)
         self.bgmatrix.scale(self.scale_xy, self.scale_xy)
 
-    def draw_shapes(self, cr):
-        sf = self.bg_image
-        x1 = sf.bbox[0]
-        y1 = sf.bbox[1]
-        x2 = sf.bbox[2]
-        y2 = sf.bbox[3]
-        shapes = sf.shapes()
-        records = sf.records()
+    def get_view_matrix(self):
+        """Return the matrix that converts map coordinates to the screen, used by the vertices"""
+        origin = cairo.Matrix(x0=-self.map_origin[0], y0=-self.map_origin[1])
+        return origin.multiply(self.get_shapes_matrix())
+
+    def get_shapes_matrix(self):
+        """Return the matrix that converts coordinates relative to the corner of the map to the screen, used by the
+        shapes"""
+        return self.map_matrix.multiply(self.bgmatrix)
+
+    def get_shapes_level(self):
+        """Return the level of detail of the shapes for the current zoom. The shapes are simplified with a tolerance,
+        in map units, of 2 ** level, which is the power of two below half of the size of a screen pixel."""
+        m = self.get_shapes_matrix()
+        pixel = 1 / numpy.sqrt(abs(m.xx * m.yy - m.xy * m.yx))
+        return int(numpy.floor(numpy.log2(pixel / 2)))
+
+    def get_shapes_geometry(self, level):
+        """Return the geometry of the shapes simplified for a level of detail, simplifying it on the first use"""
+        if level not in self.bg_levels:
+            self.bg_levels[level] = self.bg_geometry.simplify(2.0 ** level)
+        return self.bg_levels[level]
+
+    def get_shapes_paths(self, cr, level, shapes):
+        """Return the cairo path, relative to the corner of the map, and the color of each shape in the list. The
+        paths are built on the first use and kept until the level of detail changes."""
+        if self.shapes_paths is None or self.shapes_paths_key != level:
+            self.shapes_paths = {}
+            self.shapes_paths_key = level
+        geometry = self.get_shapes_geometry(level)
 
         legend_color = {'AGRICULTURA': (181 / 255, 200 / 255, 103 / 255),
                         'AREAS CAMPESTRES': (181 / 255, 200 / 255, 103 / 255),
@@ -435,39 +524,77 @@ class GraphWidgetWithBackImage(Gtk.DrawingArea):
                         'Massa_agua': (166 / 255, 206 / 255, 227 / 255)
                         }
 
-        for i in range(len(shapes)):
-            cr.set_line_width(9)
-            color = legend_color[
-                records[i][6]]  # Need to read the record's position 6 to identify the field related to the color
-            cr.set_source_rgb(color[0], color[1], color[2])
-
-            start_polygon = True
-            coord = shapes[i].points
-            for j in range(len(shapes[i].points)):
-                # Normalization of geospatial coordinates
-                x_norm = (coord[j][0] - x1) / (x2 - x1)
-                y_norm = (coord[j][1] - y1) / (y2 - y1)
-
-                # Need to consider the origin on the top left corner, not at the bottom left corner. This makes total
-                # difference when drawing the shapes. Besides, the aspect ratio need to be considered too.
-                x_draw_point = (x_norm * self.widget_width) / 4
-                y_draw_point = (self.widget_height - (y_norm * self.widget_height)) / 3
-
-                if j in shapes[i].parts:
-                    # if "j" is on the start of a new shape, then need to move the brushes to the start point without
-                    # draw a line connecting the last point to the actual
-                    start_polygon = True
-
-                if start_polygon:
-                    # if is the first point of a shape part, then move the brushes to the initial point to start drawing
-                    cr.move_to(x_draw_point, y_draw_point)
-                    start_polygon = False
+        cr.save()
+        cr.identity_matrix()
+        cr.new_path()
+        for i in shapes:
+            if i in self.shapes_paths:
+                continue
+            start = geometry.pointOffsets[i]
+            # The paths are built without a matrix, and cairo keeps their points as fixed point numbers that can not
+            # hold large map coordinates, like the northings of UTM on the southern hemisphere. The points are moved
+            # to the corner of the map, the map matrix places them when the shapes are drawn.
+            points = (geometry.points[start:geometry.pointOffsets[i + 1]] - self.map_origin).tolist()
+            # The index of the first point of each part, and the end of the shape
+            parts = geometry.shapeParts(i).tolist() + [len(points)]
+            for begin, end in zip(parts[:-1], parts[1:]):
+                # Move the brushes to the first point of each part without draw a line connecting it to the last part
+                cr.move_to(*points[begin])
+                for j in range(begin + 1, end):
+                    cr.line_to(*points[j])
+            color = legend_color[self.bg_habitats[self.bg_habitat[i]]]
+            self.shapes_paths[i] = (color, cr.copy_path())
+            cr.new_path()
+        cr.restore()
+        return [self.shapes_paths[i] for i in shapes]
 
-                else:
-                    # Draw a line from last point to actual
-                    cr.line_to(x_draw_point, y_draw_point)
+    def get_shapes_bbox(self, matrix, width, height):
+        """Return the bounding box [xmin, ymin, xmax, ymax], in map coordinates, of a surface of the size given drawn
+        with a matrix from coordinates relative to the corner of the map"""
+        inverse = cairo.Matrix(*matrix)
+        inverse.invert()
+        corners = numpy.array([inverse.transform_point(x, y) for x in (0, width) for y in (0, height)])
+        corners += self.map_origin
+        return corners.min(axis=0).tolist() + corners.max(axis=0).tolist()
 
-            cr.fill()
+    def draw_shapes(self, cr):
+        """Paint the shapes on the background. The shapes are rasterized to a surface three times the size of the
+        widget, like the graph surface, that is kept while the widget size and the zoom do not change. Panning only
+        moves the surface, until the widget gets near to its border. The shapes outside the surface are skipped with
+        the spatial index of the shapefile. The detail of the shapes follows the zoom, so the points that would fall
+        on the same pixel are not drawn."""
+        m = self.bgmatrix
+        key = (self.widget_width, self.widget_height, m.xx, m.yx, m.xy, m.yy)
+        width, height = self.widget_width, self.widget_height
+        if self.shapes_layer is not None and self.shapes_layer_key == key:
+            dx = m.x0 - self.shapes_layer_origin[0]
+            dy = m.y0 - self.shapes_layer_origin[1]
+        if self.shapes_layer is None or self.shapes_layer_key != key or abs(dx) > width or abs(dy) > height:
+            self.shapes_layer = cr.get_target().create_similar(cairo.CONTENT_COLOR_ALPHA, int(width * 3),
+                                                               int(height * 3))
+            lcr = cairo.Context(self.shapes_layer)
+            # The widget is on the middle of the layer, instead of the origin of the background matrix
+            offset = cairo.Matrix()
+            offset.translate(width - self.widget_pos_x, height - self.widget_pos_y)
+            matrix = self.get_shapes_matrix().multiply(offset)
+            lcr.set_matrix(matrix)
+            # Only the shapes that touch the layer are drawn, found with the spatial index of the shapefile
+            shapes = self.bg_image.bboxQuery(self.get_shapes_bbox(matrix, width * 3, height * 3)).tolist()
+            for color, path in self.get_shapes_paths(lcr, self.get_shapes_level(), shapes):
+                lcr.set_source_rgb(color[0], color[1], color[2])
+                lcr.append_path(path)
+                lcr.fill()
+            self.shapes_layer_key = key
+            self.shapes_layer_origin = (m.x0, m.y0)
+            dx = dy = 0
+
+        cr.save()
+        cr.identity_matrix()
+        cr.rectangle(self.widget_pos_x, self.widget_pos_y, width, height)
+        cr.clip()
+        cr.set_source_surface(self.shapes_layer, self.widget_pos_x - width + dx, self.widget_pos_y - height + dy)
+        cr.paint()
+        cr.restore()
 
     def cleanup(self):
         """Cleanup callbacks."""
@@ -595,6 +722,7 @@ class GraphWidgetWithBackImage(Gtk.DrawingArea):
                                    -self.img_height * self.scale_xy)
 
         if self.regenerate_generator is None:
+            self.update_vertex_grid()
             cr = cairo.Context(self.base)
             cr.set_source_rgba(*self.bg_color)
             cr.paint()
@@ -615,6 +743,53 @@ class GraphWidgetWithBackImage(Gtk.DrawingArea):
                 self.regen_context = None
         self.lazy_regenerate = False
 
+    def update_vertex_grid(self):
+        """Build the grid used by redraw_vertices with the current graph, positions and vertex sizes"""
+        if self.g.num_vertices() == 0:
+            self.vertex_grid = None
+            return
+        # Margin around each vertex enough to cover its shape, halo and the arrows of its edges
+        size = self.vprops.get("size", _vdefaults["size"])
+        if isinstance(size, PropertyMap):
+            size = size.fa.max()
+        self.vertex_grid = VertexGrid(self.g, self.pos, 2 * size)
+
+    def redraw_vertices(self, vertices):
+        r"""Draw again only the vertices in the list and their incident edges on the graph surface, instead of
+        regenerating the whole surface. The regions around the vertices are cleared and everything that intersects
+        them is drawn again, clipped to them."""
+        if (self.base is None or self.regenerate_generator is not None or
+            self.lazy_regenerate or self.g.num_vertices() == 0 or self.vertex_grid is None or
+            self.vertex_grid.num_vertices != self.g.num_vertices()):
+            self.regenerate_surface(reset=True)
+            return
+        vertices = numpy.asarray(vertices, dtype="int64")
+        if len(vertices) == 0:
+            return
+        if len(vertices) > self.g.num_vertices() // 4:
+            # Clipping many small regions is slower than drawing everything
+            self.regenerate_surface(reset=True)
+            return
+
+        grid = self.vertex_grid
+        boxes_min, boxes_max = grid.get_boxes(vertices)
+        near = grid.get_near(vertices)
+
+        cr = cairo.Context(self.base)
+        cr.set_matrix(self.tmatrix)
+        for low, high in zip(boxes_min, boxes_max):
+            cr.rectangle(low[0], low[1], high[0] - low[0], high[1] - low[1])
+        cr.clip()
+        cr.set_operator(cairo.OPERATOR_SOURCE)
+        cr.set_source_rgba(*self.bg_color)
+        cr.paint()
+        cr.set_operator(cairo.OPERATOR_OVER)
+        grid.filter.a[near] = True
+        u = GraphView(self.g, vfilt=grid.filter)
+        cairo_draw(u, self.pos, cr, self.vprops, self.eprops, self.vorder,
+                   self.eorder, self.nodesfirst, res=5 * self.get_scale_factor(), **self.kwargs)
+        grid.filter.a[near] = False
+
     def draw(self, da, cr):
         r"""Redraw the widget."""
 
@@ -829,6 +1004,9 @@ class GraphWidgetWithBackImage(Gtk.DrawingArea):
 
     def apply_transform(self):
         r"""Apply current transform matrix to vertex coordinates."""
+        if self.map_matrix is not None:
+            # The positions are map coordinates, which must not change with the view
+            return
         zoom = self.pos_from_device((1, 0), dist=True)[0]
         apply_transforms(self.g, self.pos, self.smatrix.multiply(self.tmatrix))
         self.tmatrix = cairo.Matrix()
@@ -845,6 +1023,9 @@ class GraphWidgetWithBackImage(Gtk.DrawingArea):
 
     def fit_to_window(self, ink=False, g=None):
         r"""Fit graph to image, if there is a background image, otherwise fit the graph to window."""
+        if self.map_matrix is not None:
+            self.fit_map()
+            return
         geometry = [self.img_width * self.scale_xy, self.img_height * self.scale_xy]
         ox = 0
         oy = 0
@@ -882,6 +1063,18 @@ class GraphWidgetWithBackImage(Gtk.DrawingArea):
         if self.background is not None and self.bg_image is not None:
             self.fit_bg_image()
 
+    def fit_map(self):
+        r"""Fit the map to the image. The vertex positions are map coordinates, so the vertices are drawn with the
+        same matrix of the shapes. The sizes of vertices and edges are given in pixels and converted to map units."""
+        self.fit_bg_image()
+        self.tmatrix = self.get_view_matrix()
+        self.smatrix = cairo.Matrix()
+        m = self.tmatrix
+        ink_scale = 1 / numpy.sqrt(abs(m.xx * m.yy - m.xy * m.yx))
+        if ink_scale != self.ink_scale:
+            scale_ink(ink_scale / self.ink_scale, self.vprops, self.eprops)
+            self.ink_scale = ink_scale
+
     # Picking vertices
 
     def init_picked(self):
@@ -1015,6 +1208,7 @@ class GraphWidgetWithBackImage(Gtk.DrawingArea):
                 elif self.vertex_matrix is not None:
                     self.vertex_matrix.update_vertex(self.picked, p)
                 self.moved_picked = True
+                self.vertex_grid = None  # built again by the next regeneration
                 self.queue_draw()
         elif (state & Gdk.ModifierType.BUTTON2_MASK or
               (state & Gdk.ModifierType.BUTTON1_MASK and
@@ -1175,6 +1369,7 @@ class GraphWidgetWithBackImage(Gtk.DrawingArea):
                     for v in u.vertices():
                         self.vertex_matrix.add_vertex(self.g.vertex(int(v)))
                 self.moved_picked = True
+                self.vertex_grid = None  # built again by the next regeneration
 
         self.queue_draw()
 
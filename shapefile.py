@@ -9,7 +9,7 @@ Compatible with Python versions 2.7-3.x
 
 __version__ = "1.2.12"
 
-from struct import pack, unpack, calcsize, error, Struct
+from struct import pack, unpack, unpack_from, calcsize, error, Struct
 import os
 import sys
 import time
@@ -17,8 +17,15 @@ import array
 import tempfile
 import itertools
 import io
+import mmap
 from datetime import date
 
+try:
+    import numpy
+except ImportError:
+    # NumPy is only required by Reader.geometry()
+    numpy = None
+
 #
 # Constants for shape types
 NULL = 0
@@ -199,6 +206,177 @@ class _ShapeRecord:
         self.shape = shape
         self.record = record
 
+class _Geometry:
+    """The geometry of all shapes of a shapefile as NumPy arrays. The
+    points of the whole file are stored in a single (n, 2) float64
+    buffer and the points of shape i are the rows between
+    pointOffsets[i] and pointOffsets[i + 1]. The parts are stored the
+    same way, with the index of the first point of each part relative
+    to the start of its shape, as in _Shape.parts."""
+    def __init__(self, shapeTypes, bboxes, points, pointOffsets, parts, partOffsets):
+        self.shapeTypes = shapeTypes
+        self.bboxes = bboxes
+        self.points = points
+        self.pointOffsets = pointOffsets
+        self.parts = parts
+        self.partOffsets = partOffsets
+
+    def __len__(self):
+        return len(self.shapeTypes)
+
+    def shapePoints(self, i):
+        """Returns a (n, 2) view of the points of a shape."""
+        return self.points[self.pointOffsets[i]:self.pointOffsets[i + 1]]
+
+    def shapeParts(self, i):
+        """Returns an int32 view of the parts of a shape."""
+        return self.parts[self.partOffsets[i]:self.partOffsets[i + 1]]
+
+    def simplify(self, tolerance):
+        """Returns a new _Geometry with the parts of each polyline and
+        polygon simplified by the Douglas-Peucker algorithm: points
+        closer than tolerance to the line that replaces them are
+        dropped. The first and last points of each part are always
+        kept, so closed rings stay closed."""
+        keep = numpy.ones(len(self.points), dtype=bool)
+        for i in range(len(self)):
+            # MultiPatch parts are triangle strips and fans, which can
+            # not be simplified as lines
+            if self.shapeTypes[i] not in (3,5,13,15,23,25):
+                continue
+            start = self.pointOffsets[i]
+            bounds = (self.shapeParts(i) + start).tolist() + [self.pointOffsets[i + 1]]
+            for begin, end in zip(bounds[:-1], bounds[1:]):
+                if end - begin > 3:
+                    keep[begin:end] = _douglasPeucker(self.points[begin:end], tolerance)
+        # Each shape and part starts at the number of points kept before
+        # its first point
+        kept = numpy.concatenate(([0], numpy.cumsum(keep)))
+        pointOffsets = kept[self.pointOffsets]
+        shapeOfPart = numpy.repeat(numpy.arange(len(self)), numpy.diff(self.partOffsets))
+        partStarts = self.pointOffsets[shapeOfPart] + self.parts
+        parts = (kept[partStarts] - pointOffsets[shapeOfPart]).astype(numpy.int32)
+        return _Geometry(self.shapeTypes, self.bboxes, self.points[keep], pointOffsets, parts, self.partOffsets)
+
+def _douglasPeucker(points, tolerance):
+    """Returns a mask of the points of a line kept by the
+    Douglas-Peucker simplification."""
+    keep = numpy.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    # A closed ring is split at its farthest point from the first one,
+    # since the line from the first point to the last has no length
+    stack = [(0, len(points) - 1)]
+    if numpy.array_equal(points[0], points[-1]):
+        far = int(numpy.argmax(numpy.hypot(*(points - points[0]).T)))
+        if far == 0:
+            return keep
+        keep[far] = True
+        stack = [(0, far), (far, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        segment = points[last] - points[first]
+        inner = points[first + 1:last] - points[first]
+        length = numpy.hypot(segment[0], segment[1])
+        if length > 0:
+            distance = numpy.abs(inner[:, 0] * segment[1] - inner[:, 1] * segment[0]) / length
+        else:
+            distance = numpy.hypot(inner[:, 0], inner[:, 1])
+        farthest = int(numpy.argmax(distance))
+        if distance[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return keep
+
+class _RTree:
+    """An R-tree over the bounding boxes of the shapes, packed with the
+    Sort-Tile-Recursive algorithm. Each level keeps the boxes of its
+    entries in the order of the tree, and each entry above the leaves
+    covers a range of consecutive entries of the level below. Queries
+    descend the levels testing many boxes at once with NumPy. Null
+    shapes have a NaN box, which is ignored by the boxes of the nodes,
+    so the other shapes of the node are still found:
+
+    >>> boxes = [[i, 0, i + 1, 1] for i in range(40)]
+    >>> boxes[5] = [float("nan")] * 4
+    >>> len(_RTree(boxes).intersection([-1, -1, 41, 2]))
+    39
+    """
+    def __init__(self, bboxes, nodeCapacity=16):
+        self.nodeCapacity = nodeCapacity
+        boxes = numpy.asarray(bboxes, dtype=numpy.float64).reshape(-1, 4)
+        ids = numpy.arange(len(boxes))
+        ranges = None
+        self.levels = []
+        while True:
+            order = self.__tileOrder(boxes)
+            boxes = boxes[order]
+            if ranges is None:
+                ids = ids[order]
+            else:
+                ranges = ranges[order]
+            self.levels.append((boxes, ranges))
+            if len(boxes) <= nodeCapacity:
+                break
+            # Group each run of nodeCapacity consecutive entries in a node
+            starts = numpy.arange(0, len(boxes), nodeCapacity)
+            ranges = numpy.column_stack((starts, numpy.minimum(starts + nodeCapacity, len(boxes))))
+            # fmin and fmax skip the NaN boxes of null shapes, which would
+            # make the box of the whole node NaN
+            boxes = numpy.column_stack((numpy.fmin.reduceat(boxes[:, 0], starts),
+                                        numpy.fmin.reduceat(boxes[:, 1], starts),
+                                        numpy.fmax.reduceat(boxes[:, 2], starts),
+                                        numpy.fmax.reduceat(boxes[:, 3], starts)))
+        self.ids = ids
+        self.levels.reverse()
+
+    def __tileOrder(self, boxes):
+        """Sorts boxes in vertical slices by the x of their centers and
+        each slice by the y, so consecutive boxes are close together."""
+        count = len(boxes)
+        if count <= self.nodeCapacity:
+            return numpy.arange(count)
+        nodes = -(-count // self.nodeCapacity)
+        sliceSize = -(-nodes // int(numpy.ceil(numpy.sqrt(nodes)))) * self.nodeCapacity
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        byX = numpy.argsort(centers[:, 0], kind="stable")
+        slices = numpy.arange(count) // sliceSize
+        return byX[numpy.lexsort((centers[byX, 1], slices))]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def query(self, boxes):
+        """Finds the shapes which bounding box intersects each one of
+        the (n, 4) query boxes. Returns two arrays with one item for
+        each intersection: the index of the query box and the index of
+        the shape."""
+        boxes = numpy.asarray(boxes, dtype=numpy.float64).reshape(-1, 4)
+        queries = numpy.repeat(numpy.arange(len(boxes)), len(self.levels[0][0]))
+        entries = numpy.tile(numpy.arange(len(self.levels[0][0])), len(boxes))
+        for level, (entryBoxes, ranges) in enumerate(self.levels):
+            eb = entryBoxes[entries]
+            qb = boxes[queries]
+            hit = (eb[:, 0] <= qb[:, 2]) & (eb[:, 2] >= qb[:, 0]) & (eb[:, 1] <= qb[:, 3]) & (eb[:, 3] >= qb[:, 1])
+            queries = queries[hit]
+            entries = entries[hit]
+            if ranges is not None:
+                # Descend to the entries covered by each node hit
+                starts = ranges[entries, 0]
+                counts = ranges[entries, 1] - starts
+                offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+                queries = numpy.repeat(queries, counts)
+                entries = numpy.repeat(starts, counts) + offsets
+        return queries, self.ids[entries]
+
+    def intersection(self, bbox):
+        """Returns the sorted indexes of the shapes which bounding box
+        intersects the bbox [xmin, ymin, xmax, ymax]."""
+        return numpy.sort(self.query([bbox])[1])
+
 class ShapefileException(Exception):
     """An exception to handle shapefile specific problems."""
     pass
@@ -227,10 +405,13 @@ class Reader:
         self.dbf = None
         self.shapeName = "Not specified"
         self._offsets = []
+        self._spatialIndex = None
         self.shpLength = None
         self.numRecords = None
         self.fields = []
         self.__dbfHdrLength = 0
+        # Map the files opened by name into memory instead of reading them
+        self.useMmap = kwargs.get("mmap", False)
         # See if a shapefile name was passed as an argument
         if len(args) > 0:
             if is_string(args[0]):
@@ -289,11 +470,27 @@ class Reader:
                 pass
             if not (self.shp and self.dbf):
                 raise ShapefileException("Unable to open %s.dbf or %s.shp." % (shapeName, shapeName) )
+            if self.useMmap:
+                self.shp = self.__mapFile(self.shp)
+                self.shx = self.__mapFile(self.shx)
+                self.dbf = self.__mapFile(self.dbf)
         if self.shp:
             self.__shpHeader()
         if self.dbf:
             self.__dbfHeader()
 
+    def __mapFile(self, f):
+        """Maps a file into memory. A mmap object supports seek and read
+        like a file, but the data is only paged in when touched and the
+        pages are shared by all processes mapping the same file."""
+        if f is None:
+            return f
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # Empty files can not be mapped
+            return f
+
     def __getFileObj(self, f):
         """Checks to see if the requested shapefile file object is
         available. If not a ShapefileException is raised."""
@@ -409,7 +606,10 @@ class Reader:
             shx.seek(100)
             shxRecords = _Array('i')
             # Each offset consists of two nrs, only the first one matters
-            shxRecords.fromfile(shx, 2 * numRecords)
+            if PYTHON3:
+                shxRecords.frombytes(shx.read(8 * numRecords))
+            else:
+                shxRecords.fromstring(shx.read(8 * numRecords))
             if sys.byteorder != 'big':
                  shxRecords.byteswap()
             self._offsets = [2 * el for el in shxRecords[::2]]
@@ -445,6 +645,115 @@ class Reader:
             shapes.append(self.__shape())
         return shapes
 
+    def __shpBuffer(self):
+        """Returns a buffer with the content of the .shp file. A memory
+        mapped file is used directly, without copying it."""
+        shp = self.__getFileObj(self.shp)
+        if isinstance(shp, mmap.mmap):
+            return shp
+        shp.seek(0)
+        return shp.read()
+
+    def __recordOffsets(self, data):
+        """Returns the offsets of all records of the .shp file, from the
+        index file if available or walking the record headers."""
+        self.__shapeIndex()
+        if not self._offsets:
+            position = 100
+            while position + 8 <= len(data):
+                self._offsets.append(position)
+                position += 8 + 2 * unpack_from(">i", data, position + 4)[0]
+        return self._offsets
+
+    def __shapeArrays(self, data, offset):
+        """Returns the shape type, bounding box, points and parts of the
+        record at the offset, with the points and parts as NumPy views
+        of the buffer."""
+        content = offset + 8
+        shapeType = unpack_from("<i", data, content)[0]
+        # Null shapes have no bounding box and never match a query
+        bbox = (float("nan"),) * 4
+        nParts = nPoints = 0
+        pointsStart = partsStart = content
+        if shapeType in (1,11,21):
+            nPoints = 1
+            pointsStart = content + 4
+            bbox = unpack_from("<2d", data, pointsStart) * 2
+        elif shapeType in (8,18,28):
+            bbox = unpack_from("<4d", data, content + 4)
+            nPoints = unpack_from("<i", data, content + 36)[0]
+            pointsStart = content + 40
+        elif shapeType in (3,5,13,15,23,25,31):
+            bbox = unpack_from("<4d", data, content + 4)
+            nParts, nPoints = unpack_from("<2i", data, content + 36)
+            partsStart = content + 44
+            pointsStart = partsStart + 4 * nParts
+            if shapeType == 31:
+                # Skip the part types of the MultiPatch
+                pointsStart += 4 * nParts
+        points = numpy.frombuffer(data, dtype="<f8", count=2 * nPoints, offset=pointsStart).reshape(-1, 2)
+        parts = numpy.frombuffer(data, dtype="<i4", count=nParts, offset=partsStart)
+        return shapeType, bbox, points, parts
+
+    def shapeArrays(self, i=0):
+        """Returns the points of a shape as a (n, 2) NumPy array and its
+        parts as an int32 array, decoding only that shape. When the
+        Reader was created with mmap=True the arrays are read-only
+        views of the memory mapped .shp file, so processes reading the
+        same file share its pages. Requires NumPy."""
+        if numpy is None:
+            raise ShapefileException("Shapefile Reader requires NumPy to read the geometry as arrays.")
+        data = self.__shpBuffer()
+        offsets = self.__recordOffsets(data)
+        i = self.__restrictIndex(i)
+        shapeType, bbox, points, parts = self.__shapeArrays(data, offsets[i])
+        return points, parts
+
+    def spatialIndex(self):
+        """Returns an R-tree over the bounding boxes of the shapes,
+        built on the first call. The .sbn/.sbx index files written by
+        ESRI software use an undocumented format, so the tree is packed
+        from the shape headers instead, which takes only a pass over
+        the .shp record headers. Requires NumPy."""
+        if numpy is None:
+            raise ShapefileException("Shapefile Reader requires NumPy to build the spatial index.")
+        if self._spatialIndex is None:
+            data = self.__shpBuffer()
+            bboxes = [self.__shapeArrays(data, offset)[1] for offset in self.__recordOffsets(data)]
+            self._spatialIndex = _RTree(bboxes)
+        return self._spatialIndex
+
+    def bboxQuery(self, bbox):
+        """Returns the indexes of the shapes which bounding box
+        intersects the bbox [xmin, ymin, xmax, ymax]."""
+        return self.spatialIndex().intersection(bbox)
+
+    def geometry(self):
+        """Returns the geometry of all shapes as a _Geometry object,
+        with the coordinates of the whole file in one NumPy buffer.
+        Only the record headers are read one by one, the points and
+        parts of each shape are copied in bulk without building Python
+        tuples. Z and M values are not read."""
+        if numpy is None:
+            raise ShapefileException("Shapefile Reader requires NumPy to read the geometry as arrays.")
+        data = self.__shpBuffer()
+        offsets = self.__recordOffsets(data)
+        shapeTypes = numpy.zeros(len(offsets), dtype=numpy.int32)
+        bboxes = numpy.zeros((len(offsets), 4))
+        pointOffsets = numpy.zeros(len(offsets) + 1, dtype=numpy.int64)
+        partOffsets = numpy.zeros(len(offsets) + 1, dtype=numpy.int64)
+        points = [numpy.zeros((0, 2))]
+        parts = [numpy.zeros(0, dtype=numpy.int32)]
+        for i, offset in enumerate(offsets):
+            shapeTypes[i], bboxes[i], shapePoints, shapeParts = self.__shapeArrays(data, offset)
+            points.append(shapePoints)
+            parts.append(shapeParts)
+            pointOffsets[i + 1] = pointOffsets[i] + len(shapePoints)
+            partOffsets[i + 1] = partOffsets[i] + len(shapeParts)
+        points = numpy.concatenate(points).astype(numpy.float64)
+        parts = numpy.concatenate(parts).astype(numpy.int32)
+        return _Geometry(shapeTypes, bboxes, points, pointOffsets, parts, partOffsets)
+
     def iterShapes(self):
         """Serves up shapes in a shapefile as an iterator. Useful
         for handling large shapefiles."""
@@ -587,6 +896,79 @@ class Reader:
                 records.append(r)
         return records
 
+    def columns(self, *fieldNames):
+        """Returns the values of some fields for all records, read in a
+        single pass over the dbf file without decoding the other
+        fields. Numeric fields are returned as NumPy arrays: float64
+        with NaN for missing values, or int64 for fields without
+        decimals when no value is missing. Any other field is returned
+        dictionary encoded, as a tuple with an int32 array of codes and
+        the list of distinct values. Deleted records are skipped, as in
+        records(). Requires NumPy."""
+        if numpy is None:
+            raise ShapefileException("Shapefile Reader requires NumPy to read the records as columns.")
+        if self.numRecords is None:
+            self.__dbfHeader()
+        f = self.__getFileObj(self.dbf)
+        if isinstance(f, mmap.mmap):
+            data = f
+        else:
+            f.seek(0)
+            data = f.read()
+        # A structured dtype with only the requested fields, at their
+        # offsets inside each record
+        offsets = {}
+        position = 0
+        for (name, typ, size, deci) in self.fields:
+            offsets[name] = (position, typ, size, deci)
+            position += size
+        names = ['DeletionFlag']
+        formats = ['S1']
+        positions = [0]
+        for name in fieldNames:
+            if name not in offsets:
+                raise ShapefileException("Field %s not found on the dbf file." % name)
+            names.append('f%d' % len(names))
+            formats.append('S%d' % offsets[name][2])
+            positions.append(offsets[name][0])
+        dtype = numpy.dtype({'names': names, 'formats': formats, 'offsets': positions,
+                             'itemsize': self.__recordLength})
+        rows = numpy.frombuffer(data, dtype=dtype, count=self.numRecords, offset=self.__dbfHdrLength)
+        rows = rows[rows['DeletionFlag'] == b(' ')]
+
+        columns = {}
+        for column, name in zip(names[1:], fieldNames):
+            (position, typ, size, deci) = offsets[name]
+            values = rows[column]
+            if typ in ("N","F"):
+                columns[name] = self.__numericColumn(values, deci)
+            else:
+                distinct, codes = numpy.unique(values, return_inverse=True)
+                # Values that differ only by padding are the same value
+                labels = {}
+                remap = [labels.setdefault(u(value).strip(), len(labels)) for value in distinct.tolist()]
+                codes = numpy.array(remap, dtype=numpy.int32)[codes.reshape(-1)]
+                columns[name] = (codes, list(labels))
+        return columns
+
+    def __numericColumn(self, values, deci):
+        """Converts the raw values of a numeric dbf field to an array."""
+        values = numpy.char.strip(numpy.char.replace(numpy.char.replace(values, b('\0'), b('')), b('*'), b('')))
+        missing = values == b('')
+        try:
+            column = numpy.where(missing, b('nan'), values).astype(numpy.float64)
+        except ValueError:
+            # Not parseable as numbers, convert one by one as __record does
+            column = numpy.empty(len(values))
+            for i, value in enumerate(values.tolist()):
+                try:
+                    column[i] = float(value)
+                except ValueError:
+                    column[i] = numpy.nan
+        if not deci and not numpy.isnan(column).any():
+            return column.astype(numpy.int64)
+        return column
+
     def iterRecords(self):
         """Serves up records in a dbf file as an iterator.
         Useful for large shapefiles or dbf files."""
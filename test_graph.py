@@ -1,12 +1,20 @@
 # coding=utf-8
+import hashlib
+import json
 import math
-from random import *
+import os
+import re
 
 from graph_tool.all import *
 
+import numpy
+
+import Compartments
 import SpreadModels
 import shapefile
 
+CACHE_DIR = "cache"  # Directory where the generated graphs are saved, named by the hash of their inputs
+CACHE_VERSION = 2  # Part of the hash, so the graphs saved by an older way of generating them are not loaded
 
 class CEnvironmentGraph():
     """This class instantiate a graph-tool.Graph object and set the vertex and edge properties accordingly
@@ -17,368 +25,468 @@ class CEnvironmentGraph():
         self.g = Graph()  # Create new graph object
         self.species = species
         self.connections = connections
-        self.w_width = 0
-        self.w_height = 0
         self.max_vertex = 1000
         self.v_total = 0
-        self.pixel_step = 25
+        self.grid_step = 4000  # Distance between the points of the lattice where the vertices are placed, in meters
+        self.use_cache = True  # Load the graph from CACHE_DIR when it was already generated from the same inputs
 
         self.names = []
-        self.v_pos = []
+        self.v_pos = []  # Map coordinates of each vertex, on the projected coordinate system of the shapefile
+        self.occupied = set()  # Cells of the lattice where a vertex was already placed
         self.g.vertex_properties.position = self.g.new_vertex_property("vector<double>")
         self.g.vertex_properties.species = self.g.new_vertex_property("string")
         self.g.vertex_properties.spread_model = self.g.new_vertex_property("vector<string>")
         self.g.vertex_properties.group = self.g.new_vertex_property("vector<string>")
         self.g.vertex_properties.habitat = self.g.new_vertex_property("vector<string>")
-        self.g.vertex_properties.state = self.g.new_vertex_property("vector<string>")
+        self.g.vertex_properties.habitat_class = self.g.new_vertex_property("string")  # Habitat where the vertex is
         self.g.vertex_properties.state_color = self.g.new_vertex_property("vector<double>")
-
-    def update_dimensions(self, ww, wh, wx, wy):
-        # Update the widget dimensions where the graph is being drawn
-        self.w_width = ww
-        self.w_height = wh
-        self.w_pos_x = wx
-        self.w_pos_y = wy
+        # The states of the vertices are kept on a matrix of codes instead of vertex properties, see Compartments
+        self.set_compartments(Compartments.CCompartments(self.get_groups(), 0))
 
     def read_shapes(self, sf):
-        self.sf = shapefile.Reader(sf)
+        self.sf_path = sf
+        self.sf = shapefile.Reader(sf, mmap=True)
+        self.map_unit = self.read_map_unit(sf)
         self.x1 = self.sf.bbox[0]
         self.y1 = self.sf.bbox[1]
         self.x2 = self.sf.bbox[2]
         self.y2 = self.sf.bbox[3]
-        self.shapes = self.sf.shapes()
+        self.geometry = self.sf.geometry()  # Coordinates of all shapes on NumPy arrays
 
-    def gen_graph(self):
-        self.calc_pos()
-        self.add_vertices()
-        self.add_edges()
+        # Only the habitat class of each shape (field LEG_NIVEL2) is read from the records, as a code on the list of
+        # habitat classes
+        self.shape_habitat, self.habitats = self.sf.columns("LEG_NIVEL2")["LEG_NIVEL2"]
+        self.habitat_species = [{s["species"] for s in self.species if habitat in s["habitat"]}
+                                for habitat in self.habitats]
 
-    def calc_pos(self):
-        """ Set the vertices positions"""
-        img_width = self.w_width / 4
-        img_height = self.w_height / 3
-        width_ratio = float(self.w_width) / float(img_width)
-        height_ratio = float(self.w_height) / float(img_height)
-        self.scale_xy = min(width_ratio, height_ratio)
-
-        top = int((self.w_height / 2) - (img_height * self.scale_xy / 2))
-        left = int((self.w_width / 2) - (img_width * self.scale_xy / 2))
-        offset = (left + self.w_pos_x, top + self.w_pos_y)
+    @staticmethod
+    def read_map_unit(sf):
+        """
+        Read the length unit of the projected coordinate system of a shapefile from its .prj file.
+        :param sf: Path of the shapefile
+        :type sf: str
+        :return: Size of the unit of the map coordinates in meters, 1 if the shapefile has no .prj file
+        :rtype: float
+        """
+        try:
+            with open(os.path.splitext(sf)[0] + ".prj", "r") as prj_file:
+                wkt = prj_file.read()
+        except (IOError, OSError):
+            return 1.0
+        # The last UNIT of a PROJCS is the linear unit, the ones before it belong to the geographic system
+        units = re.findall(r'UNIT\["[^"]*",\s*([0-9.eE+-]+)', wkt)
+        if not wkt.startswith("PROJCS") or not units:
+            return 1.0
+        return float(units[-1])
+
+    def gen_graph(self, progress=None, cancelled=None):
+        """
+        Create the vertices and edges of the graph.
+        :param progress: Function called as progress(stage, done, total) while the graph is built, where stage is
+        "shapes", "vertices" or "edges"
+        :type progress: function
+        :param cancelled: Function that returns True when the generation must be stopped
+        :type cancelled: function
+        :return: False if the generation was cancelled, leaving the graph unchanged, or True otherwise
+        :rtype: bool
+        """
+        plan = self.build_graph(progress=progress, cancelled=cancelled)
+        if plan is None:
+            return False
+        self.commit_graph(plan)
+        return True
 
+    def build_graph(self, progress=None, cancelled=None):
+        """
+        Calculate the vertices and edges of a new graph without changing the graph, so it can run on another thread
+        while the graph is drawn. The result is applied to the graph by commit_graph. The parameters are the same of
+        gen_graph.
+        :return: Dictionary with the position, species and habitat of each vertex, the edges and the file where the
+        graph will be saved on the cache, or None if the generation was cancelled
+        :rtype: dict
+        """
+        if progress is None:
+            progress = lambda stage, done, total: None
+        if cancelled is None:
+            cancelled = lambda: False
+        cache_path = self.cache_path() if self.use_cache else None
+        if cache_path is not None:
+            plan = self.load_cache(cache_path)
+            if plan is not None:
+                progress("vertices", len(plan["positions"]), len(plan["positions"]))
+                progress("edges", len(plan["edges"]), len(plan["edges"]))
+                return plan
+
+        if not self.calc_pos(progress, cancelled):
+            return None
+        species, habitats = self.choose_species()
+        if cancelled():
+            return None
+        edges = self.calc_edges(numpy.array(self.v_pos, dtype=float).reshape(-1, 2), species)
+        progress("edges", len(edges), len(edges))
+        if cancelled():
+            return None
+        return {"positions": list(self.v_pos),
+                "species": species,
+                "habitats": habitats,
+                "edges": edges,
+                "cache_path": cache_path}
+
+    def commit_graph(self, plan):
+        """Replace the vertices and edges of the graph by the ones calculated by build_graph, saving the graph on the
+        cache when it was not loaded from there"""
+        self.g.clear()
+        self.add_vertices(plan["positions"], plan["species"], plan["habitats"])
+        self.g.add_edge_list(plan["edges"])
+        if plan["cache_path"] is not None:
+            self.save_cache(plan["cache_path"])
+
+    def cache_key(self):
+        """
+        Hash all the inputs the generation of the graph depends on: the shapefile, the species and their connections,
+        and the lattice parameters. The display is not one of them, the positions are map coordinates.
+        :return: Hexadecimal digest of the inputs
+        :rtype: str
+        """
+        digest = hashlib.sha256()
+        inputs = {"version": CACHE_VERSION,
+                  "species": self.species,
+                  "connections": self.connections,
+                  "grid_step": self.grid_step,
+                  "max_vertex": self.max_vertex}
+        digest.update(json.dumps(inputs, sort_keys=True).encode("utf-8"))
+        base = os.path.splitext(self.sf_path)[0]
+        for extension in (".shp", ".shx", ".dbf", ".prj"):
+            if os.path.exists(base + extension):
+                with open(base + extension, "rb") as data_file:
+                    digest.update(data_file.read())
+        return digest.hexdigest()
+
+    def cache_path(self):
+        """Return the file where the graph generated from the current inputs is saved"""
+        return os.path.join(CACHE_DIR, self.cache_key() + ".gt")
+
+    def load_cache(self, path):
+        """
+        Read a graph saved on the cache as the result of build_graph.
+        :param path: File of the graph, in the graph_tool binary format
+        :type path: str
+        :return: The same dictionary returned by build_graph, or None if the file does not exist or can not be read
+        :rtype: dict
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            g = load_graph(path, fmt="gt")
+        except (OSError, ValueError):
+            return None
+        # The species and habitats are saved by name and converted back to their position on the lists
+        species_index = {}
+        for n, s in enumerate(self.species):
+            species_index.setdefault(s["species"], n)
+        habitat_index = {habitat: code for code, habitat in enumerate(self.habitats)}
+        species = [species_index.get(g.vertex_properties.species[v]) for v in g.vertices()]
+        if None in species:
+            return None
+        habitats = [habitat_index.get(g.vertex_properties.habitat_class[v], -1) for v in g.vertices()]
+        return {"positions": [list(g.vertex_properties.position[v]) for v in g.vertices()],
+                "species": numpy.array(species, dtype=numpy.int64),
+                "habitats": numpy.array(habitats, dtype=numpy.int64),
+                "edges": numpy.asarray(g.get_edges(), dtype=numpy.int64).reshape(g.num_edges(), -1)[:, :2],
+                "cache_path": None}
+
+    def save_cache(self, path):
+        """Save the graph on the cache. The compartments are not saved, they are created again from the species when
+        the graph is loaded."""
+        compartments = Compartments.CCompartments.of_graph(self.g)
+        del self.g.graph_properties["compartments"]
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            # Written to another file first, so an interrupted save does not leave a broken graph on the cache
+            self.g.save(path + ".tmp", fmt="gt")
+            os.replace(path + ".tmp", path)
+        except OSError:
+            # The graph can still be used without the cache, it is generated again on the next time
+            pass
+        finally:
+            self.set_compartments(compartments)
+
+    def calc_pos(self, progress, cancelled):
+        """
+        Set the vertices positions.
+        :param progress: Function called after each shape, see gen_graph
+        :type progress: function
+        :param cancelled: Function that returns True when the generation must be stopped
+        :type cancelled: function
+        :return: False if the generation was cancelled, or True otherwise
+        :rtype: bool
+        """
+        self.v_pos = []
+        self.occupied = set()
         v_count = 0
-        # for i in range(len(self.shapes)):
-        for i in range(86, 87):
-            print("Shape:", i)
-            print("Parts:", self.shapes[i].parts)
+        for i in range(len(self.geometry)):
+            if cancelled():
+                return False
             species_list = self.habitat_of(i)
             species_number = len(species_list)
-            progress = int(100 * i / len(self.shapes))
-            print("Progress: " + str(progress) + "%")
             if species_number > 0:
                 if v_count < self.max_vertex:
-                    if len(self.shapes[i].parts) > 0:
-                        for n in range(1, len(self.shapes[i].parts)):
-                            coords = self.shapes[i].points[self.shapes[i].parts[n-1]: self.shapes[i].parts[n]]
-                            v_count = self.test_coord(coords=coords,
-                                                      v_count=v_count,
-                                                      offset=offset)
-                    else:
-                        v_count = self.test_coord(coords=self.shapes[i].points,
-                                                  v_count=v_count,
-                                                  offset=offset)
+                    v_count = self.test_coord(points=self.geometry.shapePoints(i),
+                                              parts=self.geometry.shapeParts(i),
+                                              v_count=v_count)
                 else:
                     break
-        print("Vertices total:", v_count)
-        if v_count == 0:
-            self.v_total = v_count
-        else:
-            self.v_total = v_count - 1
-
-    def test_coord(self, coords, v_count, offset):
-        x_max, x_min, y_max, y_min = coords[0][0], coords[0][0], coords[0][1], coords[0][1]
-        # Find maximum and minimum value of shapes coordinates
-        for j in range(len(coords)):
-            if coords[j][0] > x_max:
-                x_max = coords[j][0]
-            if coords[j][0] < x_min:
-                x_min = coords[j][0]
-
-            if coords[j][1] > y_max:
-                y_max = coords[j][1]
-            if coords[j][1] < y_min:
-                y_min = coords[j][1]
-
-        # Normalize maximum and minimum values of shape coordinates and convert to widget dimensions
-        x_max_norm = (x_max - self.x1) / (self.x2 - self.x1)
-        y_max_norm = (y_max - self.y1) / (self.y2 - self.y1)
-        x_min_norm = (x_min - self.x1) / (self.x2 - self.x1)
-        y_min_norm = (y_min - self.y1) / (self.y2 - self.y1)
-
-        # Convert to pixel coordinates
-        x_max = int(x_max_norm * self.w_width / 4)
-        x_min = int(x_min_norm * self.w_width / 4)
-        y_min = int((self.w_height - (y_max_norm * self.w_height)) / 3)
-        y_max = int((self.w_height - (y_min_norm * self.w_height)) / 3)
-
-        # Set coordinates where the vertices should be drawn
-        for row in range(y_min, y_max, self.pixel_step):
-            if v_count < self.max_vertex:
-                for column in range(x_min, x_max, self.pixel_step):
-                    # print(self.is_inside(coords, len(coords) - 1, list([column, row])))
-                    # if self.is_inside(coords, len(coords) - 1, list([column, row])) == 1:
-                    #     if v_count < self.max_vertex and [column, row] not in self.v_pos:
-                    #         self.v_pos.append([(column * self.scale_xy) + offset[0],
-                    #                            (row * self.scale_xy) + offset[1]])
-                    #
-                    #         v_count += 1
-                    if x_min <= column <= x_max and y_min <= row <= y_max:
-                        if v_count < self.max_vertex and [column, row] not in self.v_pos:
-                            self.v_pos.append([(column * self.scale_xy) + offset[0],
-                                               (row * self.scale_xy) + offset[1]])
-                            # self.v_pos.append([column, row])
-                            # print("Coordinates:", column, row)
-                            v_count += 1
-                        else:
-                            break
-            else:
+            progress("shapes", i + 1, len(self.geometry))
+            progress("vertices", v_count, self.max_vertex)
+        self.v_total = v_count
+        return True
+
+    def test_coord(self, points, parts, v_count):
+        """
+        Place vertices on the points of the lattice that lie inside the polygon of a shape.
+        :param points: Coordinates of the points of the shape
+        :type points: numpy.ndarray
+        :param parts: Index of the first point of each part of the shape
+        :type parts: numpy.ndarray
+        :param v_count: Number of vertices already placed
+        :type v_count: int
+        :return: Number of vertices placed, including the ones of this shape
+        :rtype: int
+        """
+        if len(points) < 3:
+            return v_count
+
+        # The lattice is the same for all shapes, so shapes side by side do not place vertices too close to each other
+        x_min, y_min = points.min(axis=0)
+        x_max, y_max = points.max(axis=0)
+        step = self.grid_step / self.map_unit
+        columns = numpy.arange(math.ceil(x_min / step), math.floor(x_max / step) + 1)
+        rows = numpy.arange(math.ceil(y_min / step), math.floor(y_max / step) + 1)
+        lattice = numpy.array(numpy.meshgrid(columns, rows)).reshape(2, -1).T
+        inside = self.points_inside(lattice * step, *self.polygon_sides(points, parts))
+
+        # The vertices are placed on the map coordinates of the lattice points. A cell of the lattice inside more than
+        # one shape gets only one vertex.
+        for cell in map(tuple, lattice[inside].tolist()):
+            if v_count >= self.max_vertex:
                 break
+            if cell not in self.occupied:
+                self.occupied.add(cell)
+                self.v_pos.append([cell[0] * step, cell[1] * step])
+                v_count += 1
         return v_count
 
-    def habitat_of(self, shape_index):
+    @staticmethod
+    def polygon_sides(points, parts):
         """
-        Verify what species live in the habitat specified for a shape.
-        :param shape_index: The index of the shape to be analyzed
-        :type shape_index: int
-        :return: The list of species that can live in the analyzed shape
-        :rtype: list
+        Return the sides of the polygon of a shape. Each point is connected to the next one of the same part, and the
+        last point of a part to its first one. All parts are tested together, so the points inside holes are left out.
+        :param points: Coordinates of the points of the shape
+        :type points: numpy.ndarray
+        :param parts: Index of the first point of each part of the shape
+        :type parts: numpy.ndarray
+        :return: Arrays with the first and the second point of each side
+        :rtype: tuple
         """
-        records = self.sf.records()
-        species_list = []
-        print("Shape habitat:", records[shape_index][6])
-        for s in self.species:
-            if records[shape_index][6] in s["habitat"]:
-                species_list.append(s["species"])
-        return species_list
+        parts = numpy.array(parts if len(parts) > 0 else [0], dtype=numpy.int64)
+        following = numpy.arange(1, len(points) + 1)
+        ends = numpy.append(parts[1:], len(points))
+        following[ends - 1] = parts
+        return points, points[following]
 
-    @staticmethod
-    def on_segment(p, r, q):
+    def habitat_at(self, coords):
         """
-        Given three collinear points p, q, r, the function checks if point q lies on line segment 'pr'
-        :param p: List with x and y coordinates of first point of the segment 'pr'
-        :type p: list
-        :param r: List with x and y coordinates of second point of the segment 'pr'
-        :type r: list
-        :param q: List with x and y coordinates of point to verify collinearity
-        :type q: list
-        :return: Return True if the point q is collinear to segment 'pr', False otherwise.
-        :rtype: bool
+        Find the habitat class at each point of a list of map coordinates. The spatial index of the shapefile gives the
+        shapes which bounding box contains each point, and the candidates of each shape are tested against its polygon
+        at once. When a point is inside more than one shape, the first one where some species can live is chosen.
+        :param coords: Map coordinates of the points, with one [x, y] row for each point
+        :type coords: numpy.ndarray
+        :return: Code of the habitat class of each point on self.habitats, or -1 for the points outside all shapes
+        :rtype: numpy.ndarray
         """
-        if min(p[0], r[0]) <= q[0] <= max(p[0], r[0]) and \
-                min(p[1], r[1]) <= q[1] <= max(p[1], r[1]):
-            return True
-        else:
-            return False
+        coords = numpy.asarray(coords, dtype=float).reshape(-1, 2)
+        codes = numpy.full(len(coords), -1, dtype=numpy.int64)
+        # The last item stands for the code -1, of the points not found on any habitat yet
+        has_species = numpy.array([len(species) > 0 for species in self.habitat_species] + [False])
+        queries, shapes = self.sf.spatialIndex().query(numpy.hstack((coords, coords)))
+        order = numpy.lexsort((queries, shapes))
+        queries, shapes = queries[order], shapes[order]
+        bounds = numpy.flatnonzero(numpy.diff(shapes)) + 1
+        for candidates, shape in zip(numpy.split(queries, bounds), shapes[numpy.append(0, bounds)].tolist()):
+            if len(candidates) == 0:
+                continue
+            # Skip the points that are already on a habitat where some species can live
+            candidates = candidates[~has_species[codes[candidates]]]
+            points = self.geometry.shapePoints(shape)
+            if len(candidates) == 0 or len(points) < 3:
+                continue
+            sides = self.polygon_sides(points, self.geometry.shapeParts(shape))
+            inside = candidates[self.points_inside(coords[candidates], *sides)]
+            codes[inside] = self.shape_habitat[shape]
+        return codes
 
     @staticmethod
-    def orientation(p, q, r):
+    def points_inside(points, starts, ends, chunk_size=2 ** 20):
         """
-        To find orientation of ordered triplet (p, q, r).
-        The function returns following values
-        0 --> p, q and r are collinear
-        1 --> Clockwise
-        2 --> Counterclockwise
-        :param p: List with x and y coordinates of first point of the segment 'pq'
-        :type p: list
-        :param q: List with x and y coordinates of second point of the segment 'pq'
-        :type q: list
-        :param r: List with x and y coordinates of point to verify the orientation
-        :type r: list
-        :return: Return a integer correspondent to the orientation of segment 'pq' related to point r
-        :rtype: int
+        Verify which points lie inside a polygon, counting how many sides of the polygon are crossed by a ray from
+        each point to the right. All points and sides are tested at once with array operations.
+        :param points: Array with the x and y coordinates of the points
+        :type points: numpy.ndarray
+        :param starts: Array with the coordinates of the first point of each side of the polygon
+        :type starts: numpy.ndarray
+        :param ends: Array with the coordinates of the second point of each side of the polygon
+        :type ends: numpy.ndarray
+        :param chunk_size: Maximum number of point and side pairs tested at once
+        :type chunk_size: int
+        :return: Boolean array, True for the points where the number of crossings is odd
+        :rtype: numpy.ndarray
         """
-        # See https://www.geeksforgeeks.org/orientation-3-ordered-points/
-        # for details of below formula.
-        val = (q[1] - p[1]) * (r[0] - q[0]) - (q[0] - p[0]) * (r[1] - q[1])
-        if val == 0:
-            return 0  # collinear
-
-        elif val > 0:
-            return 1  # clockwise
-        else:
-            return 2  # counterclockwise
+        x0, y0 = starts[:, 0], starts[:, 1]
+        x1, y1 = ends[:, 0], ends[:, 1]
+        # Only sides that are not horizontal can be crossed, and the slope is calculated only for them
+        dy = y1 - y0
+        slope = numpy.divide(x1 - x0, dy, out=numpy.zeros_like(dy), where=dy != 0)
+
+        inside = numpy.zeros(len(points), dtype=bool)
+        step = max(1, chunk_size // max(len(starts), 1))
+        for i in range(0, len(points), step):
+            px = points[i:i + step, 0:1]
+            py = points[i:i + step, 1:2]
+            crosses = ((y0 > py) != (y1 > py)) & (px < x0 + (py - y0) * slope)
+            inside[i:i + step] = numpy.count_nonzero(crosses, axis=1) % 2 == 1
+        return inside
 
-    def do_intersect(self, p1, q1, p2, q2):
+    def habitat_of(self, shape_index):
         """
-        This function verify if line segment 'p1q1' and 'p2q2' intersect each other.
-        :param p1: List with x and y coordinates of first point of the segment 'p1q1'
-        :type p1: list
-        :param q1: List with x and y coordinates of second point of the segment 'p1q1'
-        :type q1: list
-        :param p2: List with x and y coordinates of first point of the segment 'p2q2'
-        :type p2: list
-        :param q2: List with x and y coordinates of second point of the segment 'p2q2'
-        :type q2: list
-        :return: Return True if segment 'p1q1' intersects segment 'p2q2'
-        :rtype: bool
+        Verify what species live in the habitat specified for a shape.
+        :param shape_index: The index of the shape to be analyzed
+        :type shape_index: int
+        :return: The list of species that can live in the analyzed shape
+        :rtype: list
         """
-        # Find the four orientations needed for general and special cases
-        o1 = self.orientation(p1, q1, p2)
-        o2 = self.orientation(p1, q1, q2)
-        o3 = self.orientation(p2, q2, p1)
-        o4 = self.orientation(p2, q2, q1)
-
-        # General case
-        if o1 != o2 and o3 != o4:
-            return True
-
-        # Special Cases
-        # p1, q1 and p2 are collinear and p2 lies on segment p1q1
-        if o1 == 0 and self.on_segment(p1, q1, p2):
-            return True
-
-        # p1, q1 and p2 are collinear and q2 lies on segment p1q1
-        if o2 == 0 and self.on_segment(p1, q1, q2):
-            return True
+        return sorted(self.habitat_species[self.shape_habitat[shape_index]])
 
-        # p2, q2 and p1 are collinear and p1 lies on segment p2q2
-        if o3 == 0 and self.on_segment(p2, q2, p1):
-            return True
-
-        # p2, q2 and q1 are collinear and q1 lies on segment p2q2
-        if o4 == 0 and self.on_segment(p2, q2, q1):
-            return True
-
-        return False  # Doesn't fall in any of the above cases
-
-    def is_inside(self, polygon, n, p):
+    def choose_species(self):
         """
-        Returns true if the point p lies inside the polygon[] with n vertices
-        :param polygon: List of x and y coordinates that compose the polygon
-        :type polygon: list
-        :param n: Polygon number of vertices
-        :type n: int
-        :param p: Points that compose the polygon
-        :type p: list
-        :param shape: Object with information about the polygon to check if the point is within
-        :type shape: object
-        :return: Return True if the number of intersections is odd, which means the point is inside the polygon,
-        False otherwise
-        :rtype: bool
+        Choose the species of each vertex placed by calc_pos. Each vertex gets one of the species that can live on the
+        habitat where it is. The vertices outside all habitats, or on a habitat where no species can live, get any
+        species.
+        :return: Index of the species of each vertex on the species list and code of the habitat where it is, -1 for
+        the vertices outside all habitats
+        :rtype: tuple
         """
-        # There must be at least 3 vertices in polygon[]
-        if n < 3:
-            return False
-
-        # Create a point for line segment from p to infinite
-        extreme = [self.w_width, p[1]]
-
-        # # Convert point in widget dimension to shape coordinates
-        #
-        # p[0] = (p[0] - self.w_pos_x) / ((self.w_width / 4) - self.w_pos_x)
-        # p[1] = (p[1] - self.w_pos_y) / ((self.w_height / 3) - self.w_pos_y)
-        # extreme[0] = (extreme[0] - self.w_pos_x) / ((self.w_width / 4) - self.w_pos_x)
-        # extreme[1] = (extreme[1] - self.w_pos_y) / ((self.w_height / 3) - self.w_pos_y)
-        #
-        # p[0] = (p[0] * (self.x2 - self.x1)) + self.x1
-        # p[1] = (p[1] * (self.y2 - self.y1)) + self.y1
-        # extreme[0] = (extreme[0] * (self.x2 - self.x1)) + self.x1
-        # extreme[1] = (extreme[1] * (self.y2 - self.y1)) + self.y1
-
-        # Count intersections of the above line with sides of polygon
-        count = 0
-        i = 0
-        while True:
-            next = (i+1) % n
-            p1 = list(polygon[i])
-            q1 = list(polygon[next])
-
-            # Normalize values of shape coordinates and convert to widget dimensions
-            p1[0] = (p1[0] - self.x1) / (self.x2 - self.x1)
-            p1[1] = (p1[1] - self.y1) / (self.y2 - self.y1)
-            q1[0] = (q1[0] - self.x1) / (self.x2 - self.x1)
-            q1[1] = (q1[1] - self.y1) / (self.y2 - self.y1)
-
-            p1[0] = int((p1[0] * self.w_width) / 4)
-            p1[1] = int((self.w_height - (p1[1] * self.w_height)) / 3)
-            q1[0] = int((q1[0] * self.w_width) / 4)
-            q1[1] = int((self.w_height - (q1[1] * self.w_height)) / 3)
-
-            # Check if the line segment from 'p' to 'extreme' intersects
-            # with the line segment from 'polygon[i]' to 'polygon[next]'
-            if self.do_intersect(p1, q1, p, extreme):
-                # If the point 'p' is collinear with line segment 'i-next',
-                # then check if it lies on segment. If it lies, return true,
-                # otherwise false
-                if self.orientation(p1, q1, p) == 0:
-                    return self.on_segment(p1, q1, p)
-                count += 1
-            i = next
-            if i == 0:
-                break
-
-        # Return true if count is odd, false otherwise
-        return count & 1  # Same as (count%2 == 1)
-
-    def add_vertices(self):
+        habitats = self.habitat_at(self.v_pos[:self.v_total])
+        choice = numpy.random.randint(0, len(self.species), size=self.v_total)
+        for code, habitat in enumerate(self.habitats):
+            eligible = [n for n, s in enumerate(self.species) if habitat in s["habitat"]]
+            selected = numpy.flatnonzero(habitats == code)
+            if eligible and len(selected) > 0:
+                choice[selected] = numpy.array(eligible)[numpy.random.randint(0, len(eligible), size=len(selected))]
+        return choice, habitats
+
+    def add_vertices(self, positions, species, habitats):
         """
         Create graph vertices and species properties for each vertex.
+        :param positions: Position of each vertex, in map coordinates
+        :type positions: list
+        :param species: Index of the species of each vertex on the species list
+        :type species: numpy.ndarray
+        :param habitats: Code of the habitat where each vertex is, or -1 if it is outside all habitats
+        :type habitats: numpy.ndarray
         :return: None
         :rtype: None
         """
-        self.g.add_vertex(self.v_total)
+        if len(positions) > 0:
+            self.g.add_vertex(len(positions))
         vprop_pos = self.g.new_vertex_property("vector<double>")
+        compartments = Compartments.CCompartments(self.get_groups(), self.g.num_vertices())
 
         # Read the species properties from the JSON file and insert into vertex properties
-        for v in self.g.vertices():
-            n = randint(0, len(self.species) - 1)
+        for v, n, code in zip(self.g.vertices(), species.tolist(), habitats.tolist()):
             s = self.species[n]
+            self.g.vertex_properties.habitat_class[v] = self.habitats[code] if code >= 0 else ""
             self.g.vertex_properties.species[v] = s["species"]
             self.g.vertex_properties.spread_model[v] = s["spread_model"]
             self.g.vertex_properties.group[v] = s["group"]
             self.g.vertex_properties.habitat[v] = s["habitat"]
-            self.g.vertex_properties.state[v] = s["state"]
+            compartments.set_vertex(v, s["group"], s["spread_model"], s["state"])
             # Color for susceptible (S) state
             self.g.vertex_properties.state_color[v] = (186 / 255, 172 / 255, 18 / 255, 0.8)
 
-        for count in range(0, self.v_total, 1):
-            vprop_pos[count] = self.v_pos[count]
+        self.set_compartments(compartments)
+
+        for count in range(len(positions)):
+            vprop_pos[count] = positions[count]
 
         self.g.vertex_properties.position = vprop_pos
 
-    def add_edges(self):
-        # Create edges between graph vertices, respecting the species connections and the maximum distance
-        # between vertices.
-        count = 0
-        total = 0
+    def calc_edges(self, pos, species):
+        """
+        Calculate the edges between graph vertices, respecting the species connections and the maximum distance
+        between vertices.
+        :param pos: Position of each vertex, in map coordinates
+        :type pos: numpy.ndarray
+        :param species: Index of the species of each vertex on the species list
+        :type species: numpy.ndarray
+        :return: Array with the source and the target of each edge
+        :rtype: numpy.ndarray
+        """
         # Maximum acceptable distance between two vertices whera a edge can be created.
-        dist_max = self.pixel_step * self.scale_xy
+        dist_max = self.grid_step / self.map_unit
+        if len(pos) == 0:
+            return numpy.zeros((0, 2), dtype=numpy.int64)
+
+        # Code of the species of each vertex and a matrix telling which species can be connected to each other
+        names = list(self.connections)
+        for s in self.species:
+            if s["species"] not in names:
+                names.append(s["species"])
+        code = {name: i for i, name in enumerate(names)}
+        species = numpy.array([code[s["species"]] for s in self.species])[species]
+        connected = numpy.zeros((len(names), len(names)), dtype=bool)
         for s in self.connections:
-            vertex_list = []
-            pos_list = []
-            # Create a vertex list identifying the vertex that can be connected to a specific specie, respecting the
-            # relations described in connections.json.
-            for v in self.g.get_vertices():
-                if self.g.vertex_properties.species[v] == s:
-                    vertex_list.append(v)
-                    pos_list.append(self.g.vertex_properties.position[v])
-
-            for v2 in self.g.get_vertices():
-                # Create edges between vertices identified in the last step, whereas the maximum distance (in pixels)
-                # between them can't be greater then the value of dist_max
-                if v2 not in vertex_list and self.g.vertex_properties.species[v2] in self.connections[s]:
-                    for v1 in vertex_list:
-                        x1, y1 = self.g.vertex_properties.position[v1]
-                        x2, y2 = self.g.vertex_properties.position[v2]
-                        # print(x1, y1, x2, y2)
-                        # print(self.g.edge(v1, v2), self.g.edge(v2, v1))
-                        if math.fabs(x1 - x2) <= dist_max and math.fabs(y1 - y2) <= dist_max and \
-                            self.g.edge(v1, v2) is None and self.g.edge(v2, v1) is None:
-                            self.g.add_edge(v1, v2)
-                            count += 1
-            total += count
-            print(s, count)
-            count = 0
-        print("Edges Total:", total)
+            for c in self.connections[s]:
+                if c in code and c != s:
+                    connected[code[s], code[c]] = True
+
+        # Place the vertices on a grid of cells with side dist_max, so two vertices close enough to be connected are
+        # always on the same cell or on adjacent cells. Each vertex is compared only with the vertices of its cell
+        # and of half of the adjacent cells, so each pair of vertices is found only once.
+        cell = numpy.floor(pos / dist_max).astype(numpy.int64)
+        cell -= cell.min(axis=0) - 1
+        height = cell[:, 1].max() + 2
+        keys = cell[:, 0] * height + cell[:, 1]
+        order = numpy.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+
+        sources, targets = [], []
+        for dx, dy in ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1)):
+            neighbor_keys = sorted_keys + dx * height + dy
+            start = numpy.searchsorted(sorted_keys, neighbor_keys, side="left")
+            end = numpy.searchsorted(sorted_keys, neighbor_keys, side="right")
+            if dx == 0 and dy == 0:
+                # Inside the same cell, only the vertices after each one are compared with it
+                start = numpy.arange(1, len(order) + 1)
+            counts = numpy.maximum(end - start, 0)
+            offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+            v1 = numpy.repeat(order, counts)
+            v2 = order[numpy.repeat(start, counts) + offsets]
+            close = numpy.abs(pos[v1] - pos[v2]).max(axis=1) <= dist_max
+            sources.append(v1[close])
+            targets.append(v2[close])
+        v1 = numpy.concatenate(sources)
+        v2 = numpy.concatenate(targets)
+
+        # The edge goes from the species that has the other on its connections. When both species have each other on
+        # their connections, it goes from the one that comes first on connections.json.
+        rank = numpy.arange(len(names))
+        forward = connected[species[v1], species[v2]] & \
+            (~connected[species[v2], species[v1]] | (rank[species[v1]] < rank[species[v2]]))
+        backward = connected[species[v2], species[v1]] & ~forward
+        edges = numpy.concatenate((numpy.column_stack((v1[forward], v2[forward])),
+                                   numpy.column_stack((v2[backward], v1[backward]))))
+        return edges
 
     def get_groups(self):
         available_groups = []
@@ -392,23 +500,37 @@ class CEnvironmentGraph():
         """Return the graph object"""
         return self.g
 
-    def upd_state(self, group):
+    def set_compartments(self, compartments):
+        """Store the states of the vertices as a graph property, so they are kept together with the graph"""
+        self.g.graph_properties["compartments"] = self.g.new_graph_property("object", val=compartments)
+
+    def upd_state(self, group, state=None, vertices=None):
         """
         Change the colors of the vertices based on the Tc group to be shown to the user.
         :param group: A string with the Tc group that should be represented by the vertices colors
         :type group: str
+        :param state: Matrix with the state codes to be shown, or None to use the current state of the compartments
+        :type state: numpy.ndarray
+        :param vertices: Indexes of the vertices to be painted, or None to paint all vertices
+        :type vertices: numpy.ndarray
         :return: None
         :rtype: None
         """
-        for v in self.g.get_vertices():
-            if group in self.g.vertex_properties.group[v]:
-                # If the vertex can be infect by the Tc group passed as parameter, than change the color of the vertex
-                # to correspond to it state
-                group_list = list(self.g.vertex_properties.group[v])
-                index = group_list.index(group)
-                state = self.g.vertex_properties.state[v][index]
-                color = SpreadModels.CSIR.get_state_color(state)
-                self.g.vertex_properties.state_color[v] = color
-            else:
-                # Else, paint vertex with a neutral color to represent that it can not be infected by that group.
-                self.g.vertex_properties.state_color[v] = SpreadModels.CSIR.get_state_color("IM")
\ No newline at end of file
+        compartments = Compartments.CCompartments.of_graph(self.g)
+        if state is None:
+            state = compartments.state
+        if vertices is None:
+            vertices = numpy.arange(self.g.num_vertices())
+            colors = numpy.empty((self.g.num_vertices(), 4))
+        else:
+            vertices = numpy.asarray(vertices, dtype=numpy.int64)
+            colors = self.g.vertex_properties.state_color.get_2d_array([0, 1, 2, 3]).T
+        # Paint with a neutral color the vertices that can not be infected by the group passed as parameter
+        colors[vertices] = SpreadModels.CSIR.get_state_color("IM")
+        index = compartments.get_group_index(group)
+        if index is not None:
+            # The vertices that can be infected by the group are painted with the color of their state
+            palette = numpy.array([SpreadModels.CSIR.get_state_color(name) for name in Compartments.STATES])
+            vertices = vertices[compartments.eligible[vertices, index]]
+            colors[vertices] = palette[state[vertices, index]]
+        self.g.vertex_properties.state_color.set_2d_array(colors.T)
\ No newline at end of file